@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import fnmatch
+import os
+
+IGNORE_FILENAME = ".sunyataignore"
+
+# Editor backups were always left out of bundles; bytecode and VCS metadata are never needed by the handler either.
+DEFAULT_EXCLUDES = ["*~", "__pycache__/", "*.pyc", ".git/", ".svn/", ".hg/", ".DS_Store", IGNORE_FILENAME]
+
+def read_ignore_file(dirname):
+    path = os.path.join(dirname, IGNORE_FILENAME)
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as f:
+        lines = [l.strip() for l in f.readlines()]
+    return [l for l in lines if l and not l.startswith("#")]
+
+class BundleFilter(object):
+    # Rules work like a simplified .gitignore: the last matching rule wins, a leading ! re-includes, a trailing / only matches directories,
+    # and a pattern with a / in it is matched against the whole path inside the bundle rather than just the name.
+    def __init__(self, rules=[]):
+        self.rules = []
+        for rule in rules:
+            include = rule.startswith("!")
+            pattern = rule[1:] if include else rule
+            directory_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            anchored = "/" in pattern
+            self.rules.append((pattern.lstrip("/"), include, directory_only, anchored))
+
+    @classmethod
+    def for_directory(cls, dirname, exclude=[], include=[]):
+        return cls(DEFAULT_EXCLUDES + read_ignore_file(dirname) + list(exclude) + ["!" + pattern for pattern in include])
+
+    def excluded(self, arcname, is_dir=False):
+        name = os.path.basename(arcname)
+        excluded = False
+        for pattern, include, directory_only, anchored in self.rules:
+            if directory_only and not is_dir:
+                continue
+            if fnmatch.fnmatch(arcname if anchored else name, pattern):
+                excluded = not include
+        return excluded
+
+def bundle_entries(dirname, bundle_filter=None):
+    # Returns sorted (arcname, path on disk) pairs for everything that belongs in the bundle for dirname.
+    bundle_filter = bundle_filter if bundle_filter else BundleFilter.for_directory(dirname)
+    entries = []
+    for root, dirs, files in os.walk(dirname):
+        arcpath = os.path.relpath(root, dirname)
+        arcpath = "" if arcpath == "." else arcpath
+        dirs[:] = [d for d in dirs if not bundle_filter.excluded(os.path.join(arcpath, d), is_dir=True)]
+        for file in files:
+            arcname = os.path.join(arcpath, file)
+            if not bundle_filter.excluded(arcname):
+                entries.append((arcname, os.path.join(root, file)))
+    return sorted(entries)
+
+def analyze_entries(entries, top=20):
+    files = [(os.path.getsize(path), arcname) for arcname, path in entries]
+    directories = {}
+    for size, arcname in files:
+        parent = os.path.dirname(arcname)
+        while parent:
+            directories[parent] = directories.get(parent, 0) + size
+            parent = os.path.dirname(parent)
+    return {
+        "file_count":len(files),
+        "total_size":sum([size for size, arcname in files]),
+        "largest_files":sorted(files, reverse=True)[:top],
+        "largest_directories":sorted([(directories[d], d) for d in directories], reverse=True)[:top]
+    }
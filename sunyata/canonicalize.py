@@ -1,10 +1,18 @@
 #!/usr/bin/env python3
 
+import hashlib
 import json
 import string
 
 API_NAME=""
 
+FINGERPRINT_METADATA_KEY = "SunyataFingerprint"
+
+# Properties that can differ between two generates of the same API without changing what actually gets deployed.
+VOLATILE_PROPERTIES = {
+    "AWS::ApiGateway::Deployment": [["Description"], ["StageDescription", "Description"]]
+}
+
 def set_api(api):
     global API_NAME
     API_NAME=_strip(api)
@@ -96,6 +104,15 @@ def decanonicalize_resource_name(name):
 def canonical_function_name(name):
     return "{name}Function".format(name=name)
 
+@strip
+@prefixAPI
+def canonical_layer_name(name):
+    return "{name}Layer".format(name=name)
+
+@prefixAPI
+def canonical_shard_name(index):
+    return "Shard{index}Stack".format(index=index)
+
 @strip
 @prefixAPI
 def canonical_permissions_name(name):
@@ -127,6 +144,10 @@ def canonical_s3_key(file=None, directory=None):
     else:
         return "dir-{directory}-lambda.zip".format(directory=directory)
 
+@strip
+def canonical_layer_s3_key(name):
+    return "layer-{name}-lambda.zip".format(name=name)
+
 def canonical_template_body(template):
     if type(template) is str:
         return canonical_template_body(json.loads(template))
@@ -136,3 +157,28 @@ def compact_template_body(template):
     if type(template) is str:
         return compact_template_body(json.loads(template))
     return json.dumps(template, separators=(',',':'), sort_keys=True)
+
+def _strip_volatile(template):
+    template = json.loads(compact_template_body(template))
+    metadata = template.pop("Metadata", {})
+    metadata.pop(FINGERPRINT_METADATA_KEY, None)
+    if metadata:
+        template["Metadata"] = metadata
+    for name in template.get("Resources", {}):
+        resource = template["Resources"][name]
+        for path in VOLATILE_PROPERTIES.get(resource.get("Type", None), []):
+            parent = resource.get("Properties", {})
+            for part in path[:-1]:
+                parent = parent.get(part, {})
+            parent.pop(path[-1], None)
+    return template
+
+def template_fingerprint(template, bundle_keys={}):
+    sha = hashlib.sha256(compact_template_body(_strip_volatile(template)).encode("utf-8"))
+    sha.update(json.dumps(bundle_keys, separators=(',',':'), sort_keys=True).encode("utf-8"))
+    return sha.hexdigest()
+
+def stored_fingerprint(template):
+    if type(template) is str:
+        return stored_fingerprint(json.loads(template))
+    return template.get("Metadata", {}).get(FINGERPRINT_METADATA_KEY, None)
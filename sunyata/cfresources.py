@@ -99,7 +99,23 @@ def lambda_permission(cfname):
     }
     return permission_template
 
-def lambda_function(name, runtime, role, handler, description, timeout, memory, bucket, key, vpc_config=None):
+def lambda_layer(name, runtimes, bucket, key, description=None):
+    description = description if description else "Packages shared by several sunyata-deployed functions."
+    layer_template = {
+        "Type" : "AWS::Lambda::LayerVersion",
+        "Properties" : {
+            "CompatibleRuntimes" : runtimes,
+            "Content" : {
+                "S3Bucket" : bucket,
+                "S3Key" : key
+            },
+            "Description" : description,
+            "LayerName" : prefixAPI(name)
+        }
+    }
+    return layer_template
+
+def lambda_function(name, runtime, role, handler, description, timeout, memory, bucket, key, vpc_config=None, layers=None):
     function_template = {
         "Type" : "AWS::Lambda::Function",
         "Properties" : {
@@ -121,6 +137,8 @@ def lambda_function(name, runtime, role, handler, description, timeout, memory,
     }
     if vpc_config:
         function_template["Properties"]["VpcConfig"] = vpc_config
+    if layers:
+        function_template["Properties"]["Layers"] = layers
     return function_template
 
 def apigateway_role(function_arns):
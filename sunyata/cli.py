@@ -3,7 +3,10 @@
 import argparse
 import json
 import logging
-from sunyata.generate_api import get_deployer
+import sys
+from sunyata.generate_api import get_deployer, merge_templates, run_in_regions
+from sunyata.templatediff import format_change_set, format_diff
+from sunyata.validation import fetch_resource_spec, DEFAULT_SPEC_PATH, DEFAULT_SPEC_URL
 
 class CLIDispatcher:
 
@@ -22,27 +25,91 @@ class CLIDispatcher:
         'examine_deployed':{
             'help':'Print the CF template currently in use by this stack.'
             },
+        'validate':{
+            'help':'Check the CF template that would be generated for this stack against the CloudFormation resource specification, without calling AWS.'
+            },
+        'update_resource_spec':{
+            'help':'Download the latest CloudFormation resource specification for offline validation.'
+            },
+        'plan':{
+            'help':'Upload any changed Lambda bundles and print the changes a deploy would make to the stack, without making them.'
+            },
+        'analyze_bundles':{
+            'help':'Print the largest files and directories that would go into each Lambda bundle.',
+            'initial':'a'
+            },
         'print_api_template':{
             'help':'Print the API configuration tha\'s the result of processing the template arguments you\'ve provided.',
             'initial':'p'
             }
         }
 
+    def _in_each_region(self, kwargs, operation):
+        api = merge_templates(kwargs["templates"])
+        if kwargs["regions"]:
+            api["regions"] = kwargs["regions"]
+        results = run_in_regions(api, operation, max_concurrency=kwargs["region_concurrency"])
+        if len(results) == 1 and list(results.values())[0].succeeded:
+            print(list(results.values())[0].result)
+            return
+        for region in sorted(results.keys()):
+            result = results[region]
+            print("{region}: {outcome}".format(region=region, outcome=result.result if result.succeeded else "FAILED ({error})".format(error=result.error)))
+        if not all([result.succeeded for result in results.values()]):
+            exit(1)
+
     def create(self, **kwargs):
-        deployer = get_deployer(filenames=kwargs["templates"])
-        deployer.deploy_initial()
-        print(deployer.get_url())
+        def create_in_region(deployer):
+            deployer.deploy_initial()
+            return deployer.get_url()
+        self._in_each_region(kwargs, create_in_region)
 
     def deploy(self, **kwargs):
+        def deploy_in_region(deployer):
+            deployer.use_change_sets = deployer.use_change_sets or kwargs["change_set"]
+            deployer.redeploy_to_stages(full_redeploy=kwargs["full_redeploy"])
+            return deployer.get_url()
+        self._in_each_region(kwargs, deploy_in_region)
+
+    def plan(self, **kwargs):
         deployer = get_deployer(filenames=kwargs["templates"])
-        deployer.redeploy_to_stages(full_redeploy=kwargs["full_redeploy"])
-        print(deployer.get_url())
+        plan = deployer.plan_update()
+        print(deployer.stack_name)
+        print("Template diff:")
+        for line in format_diff(plan["diff"]):
+            print("  " + line)
+        print("Change set:")
+        for line in format_change_set(plan["changes"]):
+            print("  " + line)
 
     def examine(self, **kwargs):
-        deployer = get_deployer(filenames=kwargs["templates"])
+        deployer = get_deployer(filenames=kwargs["templates"], offline=kwargs["offline"])
         body = deployer.get_template_from_config()
         print(deployer.stack_name)
         print(body)
+        warnings = []
+        for error in deployer.local_template_errors(body, warnings):
+            print(error, file=sys.stderr)
+        for warning in warnings:
+            print("Warning: " + warning, file=sys.stderr)
+
+    def validate(self, **kwargs):
+        deployer = get_deployer(filenames=kwargs["templates"], offline=True)
+        warnings = []
+        errors = deployer.local_template_errors(deployer.get_template_from_config(), warnings)
+        for warning in warnings:
+            print("Warning: " + warning)
+        for error in errors:
+            print(error)
+        if errors:
+            exit(1)
+        print("{stack_name} is valid.".format(stack_name=deployer.stack_name))
+
+    def update_resource_spec(self, **kwargs):
+        api = merge_templates(kwargs["templates"])
+        path = api.get("resource_spec_path", DEFAULT_SPEC_PATH)
+        spec = fetch_resource_spec(url=api.get("resource_spec_url", DEFAULT_SPEC_URL), path=path)
+        print("Saved resource specification {version} to {path}".format(version=spec.get("ResourceSpecificationVersion", ""), path=path))
 
     def examine_deployed(self, **kwargs):
         deployer = get_deployer(filenames=kwargs["templates"])
@@ -50,6 +117,19 @@ class CLIDispatcher:
         print(deployer.stack_name)
         print(body)
 
+    def analyze_bundles(self, **kwargs):
+        deployer = get_deployer(filenames=kwargs["templates"], offline=True)
+        analyses = deployer.analyze_bundles(top=kwargs["top"])
+        for key in sorted(analyses.keys()):
+            analysis = analyses[key]
+            print("{key}: {file_count} files, {total_size} bytes".format(key=key, **analysis))
+            print("  Largest directories:")
+            for size, name in analysis["largest_directories"]:
+                print("    {size:>12}  {name}/".format(size=size, name=name))
+            print("  Largest files:")
+            for size, name in analysis["largest_files"]:
+                print("    {size:>12}  {name}".format(size=size, name=name))
+
     def print_api_template(self, **kwargs):
         deployer = get_deployer(filenames=kwargs["templates"])
         body = deployer.get_template_from_cf()
@@ -69,6 +149,11 @@ class CLIDispatcher:
 
         parser.add_argument('--template', dest="templates", required=True, nargs='+', help='Argument: The path to the sunyata template.  If used multiple times, the templates will be read in order and merged.  (That is, if a value is defined in the first template and then redefined in the second, the value in the second template will be the one used.)')
         parser.add_argument("-v", "--verbosity", dest="verbosity", action="count", default=0, help='Argument: Print random usually-useless information.  May or may not print anything depending on whether or not I\'ve implemented it yet, as I haven\'t right now.  Optional for all calls.  More repetitions equals more useless info, so -vv prints more than -v.')
+        parser.add_argument("--regions", nargs='+', default=None, help='Argument: The regions to create or deploy the stack in, overriding the template\'s regions.  Each region gets its own stack, and they\'re deployed side by side.')
+        parser.add_argument("--region-concurrency", type=int, default=None, help='Argument: How many regions to create or deploy in at once.')
+        parser.add_argument("--offline", action='store_true', help='Argument: Don\'t look at the deployed stack or call AWS while examining the template.  The template is generated as though the stack doesn\'t exist yet.')
+        parser.add_argument("--top", type=int, default=20, help='Argument: How many of the largest files and directories to list when analyzing bundles.')
+        parser.add_argument("--change-set", action='store_true', help='Argument: Deploy through a CloudFormation change set, logging which resources will be replaced and which updated in place before executing it.')
         parser.add_argument("--full-redeploy", action='store_true', help='Argument: Fully redeploy the stack.  This is necessary to pick up changes in the supported paths, but will cause a brief outage.')
         return parser
 
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+from botocore.config import Config
+import threading
+
+# Adaptive retries back off on throttling as well as on errors, which matters once several regions or upload threads share an account's API limits.
+DEFAULT_CLIENT_SETTINGS = {
+    "max_pool_connections":16,
+    "retry_mode":"adaptive",
+    "max_attempts":10,
+    "connect_timeout":10,
+    "read_timeout":60
+}
+
+def get_client_config(settings=None):
+    # settings is the template's client_config, which overrides any of DEFAULT_CLIENT_SETTINGS.
+    merged = dict(DEFAULT_CLIENT_SETTINGS)
+    merged.update(settings if settings else {})
+    return Config(
+        max_pool_connections=merged["max_pool_connections"],
+        retries={"mode":merged["retry_mode"], "max_attempts":merged["max_attempts"]},
+        connect_timeout=merged["connect_timeout"],
+        read_timeout=merged["read_timeout"]
+    )
+
+class ClientRegistry(object):
+    # Builds each service's client once, since every boto3 client call re-resolves credentials, endpoints and service models.
+    # Clients are thread-safe once built, so one of each is shared by every thread; only building them is locked.
+    def __init__(self, session, config=None):
+        self.session = session
+        self.config = config if config else get_client_config()
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def client(self, service):
+        with self._lock:
+            if service not in self._clients:
+                self._clients[service] = self.session.client(service, config=self.config)
+            return self._clients[service]
@@ -1,16 +1,28 @@
 #!/usr/bin/env python3
 
+import asyncio
 import boto3
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from sunyata import canonicalize
 from sunyata import cfresources as cfr
 import datetime
+import hashlib
 import json
 import logging
 import os
+import threading
 import time
 import traceback
-from sunyata.upload import upload_lambda, upload_static
+from sunyata.bundlefilter import analyze_entries
+from sunyata.clients import ClientRegistry, get_client_config, DEFAULT_CLIENT_SETTINGS
+from sunyata.layers import plan_shared_layer
+from sunyata.sharding import shard_template, DEFAULT_SHARD_SIZE, DEFAULT_SHARD_THRESHOLD, MAX_TEMPLATE_BODY_SIZE, SHARD_METADATA_KEY
+from sunyata.storage import get_storage
+from sunyata.templatediff import count_replacements, diff_templates, format_change_set, format_diff
+from sunyata.validation import load_resource_spec, validate_template, DEFAULT_SPEC_PATH
+from sunyata.upload import build_bundles, built_bundle_key, function_bundle_entries, upload_built_bundles, upload_bundle, upload_lambdas, plan_static, sync_static, prune_static, zip_entries, DEFAULT_UPLOAD_WORKERS
+from sunyata.zipcache import evict_cache, DEFAULT_CACHE_DIR, DEFAULT_CACHE_MAX_SIZE
 
 def add_line_numbers(lines, start, width):
     added_lines = []
@@ -104,8 +116,48 @@ def merge_templates(filenames):
         merged_config.update(config)
     return merged_config
 
-def get_deployer(filenames):
-    return SunyataDeployer(api=merge_templates(filenames))
+def get_deployer(filenames, region=None, offline=False):
+    return SunyataDeployer(api=merge_templates(filenames), region=region, offline=offline)
+
+DEFAULT_REGION_CONCURRENCY = 4
+
+def get_regions(api):
+    # regions can be a single region or a list of them; templates without it deploy to region, or us-east-1.
+    regions = api.get("regions", None)
+    if not regions:
+        return [api.get("region", "us-east-1")]
+    return [regions] if isinstance(regions, str) else list(regions)
+
+class RegionResult(object):
+    def __init__(self, region, result=None, error=None):
+        self.region = region
+        self.result = result
+        self.error = error
+
+    @property
+    def succeeded(self):
+        return self.error == None
+
+def _run_in_region(api, region, operation, stack_name=None):
+    return operation(SunyataDeployer(api=api, stack_name=stack_name, region=region))
+
+def run_in_regions(api, operation, max_concurrency=None, stack_name=None):
+    # Calls operation with a separate deployer for each of the template's regions, a few regions at a time.
+    # A failure in one region doesn't stop the others; every region gets a RegionResult with either what operation returned or what it raised.
+    regions = get_regions(api)
+    max_concurrency = max_concurrency if max_concurrency else api.get("region_concurrency", DEFAULT_REGION_CONCURRENCY)
+    results = {}
+    with ThreadPoolExecutor(max_workers=min(len(regions), max_concurrency)) as pool:
+        futures = {pool.submit(_run_in_region, api, region, operation, stack_name):region for region in regions}
+        for future in as_completed(futures):
+            region = futures[future]
+            try:
+                results[region] = RegionResult(region, result=future.result())
+                logging.info("Finished in {region}.".format(region=region))
+            except Exception as e:
+                logging.exception("Failed in {region}.".format(region=region))
+                results[region] = RegionResult(region, error=e)
+    return results
 
 def get_content_type(path):
     if path.endswith(".html"):
@@ -114,11 +166,37 @@ def get_content_type(path):
         return "text/css"
     return "text/html"
 
+STACK_POLL_MIN_DELAY = 1
+# Kept short so a stack that finishes during a quiet spell is noticed within a few seconds rather than after a long sleep.
+STACK_POLL_MAX_DELAY = 4
+SLOWEST_RESOURCES_REPORTED = 5
+CHANGE_SET_POLL_DELAY = 2
+# CloudFormation refuses to build a change set that wouldn't change anything, and says so with one of these.
+NO_CHANGE_REASONS = ["didn't contain changes", "No updates are to be performed"]
+
+def stack_failed(status):
+    return "FAILED" in status or "ROLLBACK" in status
+
+class StackResourceIndex(object):
+    def __init__(self, resources=[]):
+        self.by_logical_id = {}
+        self.by_type = {}
+        for resource in resources:
+            self.by_logical_id[resource["LogicalResourceId"]] = resource
+            self.by_type.setdefault(resource["ResourceType"], []).append(resource)
+
+    def get(self, logical_name):
+        return self.by_logical_id.get(logical_name, None)
+
+    def of_type(self, resource_type):
+        return self.by_type.get(resource_type, [])
+
 class SunyataDeployer(object):
     cf_infra = {}
     cf_apis = {}
     cf_roles = {}
     cf_functions = {}
+    cf_layers = {}
     cf_permissions = {}
     cf_deployments = {}
     cf_stages = {}
@@ -127,25 +205,42 @@ class SunyataDeployer(object):
     cf_models = {}
     cf_outputs = {}
 
-    def __init__(self, api, stack_name=None):
+    def __init__(self, api, stack_name=None, region=None, offline=False):
         self.api = api
         self.stage_config = self.api.get("stage_config", {})
         self.stack_name = stack_name if stack_name else "sunyata-{name}".format(name=self.api["name"])
         canonicalize.set_api(self.api["name"])
         self.stack_id = None
+        self.offline = offline
+        self._stack_cache_lock = threading.RLock()
+        self.invalidate_stack_cache()
+        self._resource_spec = None
+        self._validated_template_body = None
+        self.shard_templates = {}
+        self.template_uploads = {}
+        self._uploaded_templates = set()
         self.resources = None
         self._bucket_name = None
         self._static_bucket_name = None
         self._static_url = None
         self.lambda_functions = {}
         self.lambda_keys = {}
+        self._shared_layer = None
+        self._storage = None
         self.static_files = []
+        self.static_manifest = {}
         self.domain = self.api.get("domain_name", None)
         self.extra_cf_templates = self.api.get("extra_cloudformation_templates", [])
-        self.region = self.api.get("region", "us-east-1")
+        self.region = region if region else get_regions(self.api)[0]
         self.existing_template = None
+        self.last_stack_status = None
         self.calls_to_make = []
-        boto3.setup_default_session(region_name=self.region, profile_name=self.api.get("profile", "default"))
+        self.use_change_sets = self.api.get("use_change_sets", False)
+        # Each deployer gets its own session rather than configuring boto3's default one, so deployers for different regions can run side by side.
+        self.session = boto3.session.Session(region_name=self.region, profile_name=None if offline else self.api.get("profile", "default"))
+        self.clients = ClientRegistry(self.session, get_client_config(self._client_settings()))
+        self.cf_stages = {}
+        self.cf_outputs = {}
 
     ##### begin externally-used methods #####
 
@@ -162,35 +257,71 @@ class SunyataDeployer(object):
     def deploy_initial(self):
         if self._get_stack():
             raise RuntimeError("Stack already exists!")
+        if self.api.get("bootstrap_stack", False):
+            # With the buckets already up, the API's stack can be created complete in one operation instead of created empty and then updated.
+            self._ensure_bootstrap_stack()
+            self._upload_static_files()
+            self._upload_lambda_code()
+            self.generate()
+            self.combine()
+            self._require_success(self._create_stack(), "Creating")
+            self._finish_static_files()
+            return
         self.clear_analysis()
         self.generate_infra()
         self.combine()
-        self._create_stack()
+        self._require_success(self._create_stack(), "Creating")
         self._upload_static_files()
         self._upload_lambda_code()
         self.generate()
         self.combine()
-        self._update_stack()
+        self._require_success(self._update_stack(), "Updating")
+        self._finish_static_files()
 
     def redeploy_to_stages(self, stages=None, full_redeploy=False):
         if not self._get_stack():
             raise RuntimeError("Stack doesn't exist!")
         self.existing_template = self._get_template_body_from_cf()
         stages = self.api["stages"] if stages==None else stages
-        self._upload_static_files()
-        self._upload_lambda_code()
-        if full_redeploy:
+        if self.bootstrapped:
+            self._ensure_bootstrap_stack()
+        if self.api.get("parallel_deploy", True):
+            asyncio.run(self._prepare_update())
+        else:
+            self._upload_static_files()
+            self._upload_lambda_code()
             self.generate()
-            for stage in stages:
-                self.remove_deployments_for_stage(stage)
             self.combine()
-            self._update_stack()
-            self._make_raw_calls()
-        self.generate()
-        self.combine()
-        self._update_stack()
+        self._require_success(self._update_stack(), "Updating")
+        self._finish_static_files()
+        if full_redeploy:
+            # CloudFormation won't redeploy a stage whose Deployment resource hasn't changed, so rather than removing the deployments in
+            # one update and putting them back in a second, each stage just gets a fresh deployment once the single update is done.
+            for stage in stages:
+                self.calls_to_make.append({
+                    "service":"apigateway",
+                    "method":"create_deployment",
+                    "params":{"restApiId":{"OUTPUT":"RestApiId"}, "stageName":stage, "description":"Full redeploy of {stage}.".format(stage=stage)}
+                })
         self._make_raw_calls()
         
+    def plan_update(self):
+        # Uploads any changed bundles so the template refers to the right keys, then shows what an update would do without executing it.
+        # Static files aren't uploaded, but bundles whose config lists them still need the list a deploy would give them.
+        if not self._get_stack():
+            raise RuntimeError("Stack doesn't exist!")
+        if self._config_includes_static_files():
+            self._plan_static_files()
+        self._upload_lambda_code()
+        self.generate()
+        self.combine()
+        plan = {"diff":diff_templates(self._get_template_body_from_cf(), self.template), "changes":[]}
+        change_set_id = self._create_change_set(canonicalize.compact_template_body(self.template))
+        if change_set_id:
+            plan["changes"] = self._describe_change_set(change_set_id)
+            self.client("cloudformation").delete_change_set(ChangeSetName=change_set_id)
+        return plan
+
     def get_template_from_config(self):
         self.generate()
         self.combine()
@@ -201,6 +332,16 @@ class SunyataDeployer(object):
         body = self._get_template_body_from_cf()
         return canonicalize.canonical_template_body(body)
 
+    def analyze_bundles(self, top=20):
+        analyses = {}
+        bundles = self._get_bundles()
+        for key in bundles:
+            analyses[key] = analyze_entries(function_bundle_entries(bundles[key]), top=top)
+        layer = self._get_shared_layer()
+        if layer and layer.entries:
+            analyses[canonicalize.canonical_layer_s3_key("Shared")] = analyze_entries(layer.entries, top=top)
+        return analyses
+
     ##### end externally-used methods #####
 
     @property
@@ -209,19 +350,46 @@ class SunyataDeployer(object):
 
     @property
     def lambda_bucket_name(self):
-        self._bucket_name = self._bucket_name if self._bucket_name else self._get_stack_output("LambdaZipBucket")
+        self._bucket_name = self._bucket_name if self._bucket_name else self._get_infra_output("LambdaZipBucket")
         return self._bucket_name
 
     @property
     def static_bucket_name(self):
-        self._static_bucket_name = self._static_bucket_name if self._static_bucket_name else self._get_stack_output("StaticFileBucket")
+        self._static_bucket_name = self._static_bucket_name if self._static_bucket_name else self._get_infra_output("StaticFileBucket")
         return self._static_bucket_name
 
     @property
     def static_s3_path(self):
-        self._static_url = self._static_url if self._static_url else self._get_stack_output("StaticURL")
+        self._static_url = self._static_url if self._static_url else self._get_infra_output("StaticURL")
         return self._static_url
 
+    @property
+    def storage(self):
+        if not self._storage:
+            storage_config = self.api.get("storage", None)
+            s3 = (storage_config if storage_config else {}).get("type", "s3") == "s3"
+            self._storage = get_storage(storage_config, client=self.client("s3") if s3 else None)
+        return self._storage
+
+    def client(self, service):
+        return self.clients.client(service)
+
+    def _client_settings(self):
+        # The S3 client is shared by every upload thread, so the pool is never smaller than the largest worker count.
+        settings = dict(self.api.get("client_config", {}))
+        workers = [self.api.get("static_upload_workers", DEFAULT_UPLOAD_WORKERS), self.api.get("bundle_upload_workers", DEFAULT_UPLOAD_WORKERS)]
+        settings.setdefault("max_pool_connections", max([DEFAULT_CLIENT_SETTINGS["max_pool_connections"]] + [w for w in workers if w]))
+        return settings
+
+    @property
+    def zip_cache_dir(self):
+        if self.api.get("zip_cache", True) == False:
+            return None
+        return self.api.get("zip_cache_dir", DEFAULT_CACHE_DIR)
+
+    def _evict_zip_cache(self):
+        evict_cache(self.zip_cache_dir, self.api.get("zip_cache_max_size", DEFAULT_CACHE_MAX_SIZE))
+
     @property
     def api_name(self):
         return canonicalize.canonical_api_name(self.api["name"])
@@ -232,19 +400,87 @@ class SunyataDeployer(object):
         base_url = base_url if base_url else ""
         return base_url + "/" + stage
 
+    @property
+    def resource_spec(self):
+        if not self._resource_spec:
+            self._resource_spec = load_resource_spec(self.api.get("resource_spec_path", DEFAULT_SPEC_PATH))
+        return self._resource_spec
+
+    def local_template_errors(self, template_body, warnings=None):
+        # Checks the template and any nested stack templates it refers to against the resource specification, without calling AWS.
+        # Anything that only might be a problem goes in warnings, if that's given, rather than the returned errors.
+        warnings = warnings if warnings != None else []
+        errors = validate_template(template_body, self.resource_spec, warnings)
+        for key in sorted(self.template_uploads.keys()):
+            if key in template_body:
+                nested_warnings = []
+                errors += ["{key}: {error}".format(key=key, error=error) for error in validate_template(self.template_uploads[key], self.resource_spec, nested_warnings)]
+                warnings += ["{key}: {warning}".format(key=key, warning=warning) for warning in nested_warnings]
+        return errors
+
     def check_template(self, template_body):
-        try:
-            boto3.client("cloudformation").validate_template(TemplateBody=template_body)
-        except Exception as e:
-            logging.exception(canonicalize.canonical_template_body(template_body))
-            raise e
+        if template_body == self._validated_template_body:
+            return
+        warnings = []
+        errors = self.local_template_errors(template_body, warnings)
+        for warning in warnings:
+            logging.warning(warning)
+        if errors:
+            for error in errors:
+                logging.error(error)
+            raise RuntimeError("Template failed validation with {count} errors.".format(count=len(errors)))
+        # CloudFormation's own check catches a few more problems, but costs a round trip and needs credentials, so it can be turned off.
+        if self.api.get("remote_validation", True) and not self.offline:
+            try:
+                self.client("cloudformation").validate_template(**self._template_args(template_body))
+            except Exception as e:
+                logging.exception(canonicalize.canonical_template_body(template_body))
+                raise e
+        self._validated_template_body = template_body
+
+    def _template_url(self, key):
+        return "https://{bucket}.s3.{region}.amazonaws.com/{key}".format(bucket=self.lambda_bucket_name, region=self.region, key=key)
+
+    def _upload_template(self, key, body):
+        if key not in self._uploaded_templates:
+            self.storage.put_object(self.lambda_bucket_name, key, body.encode("utf-8"), content_type="application/json")
+            self._uploaded_templates.add(key)
+
+    def _template_args(self, template_body):
+        # Nested stack templates, and any template too big to pass inline, go to the Lambda bucket for CloudFormation to read from there.
+        for key in sorted(self.template_uploads.keys()):
+            if key in template_body:
+                self._upload_template(key, self.template_uploads[key])
+        if len(template_body.encode("utf-8")) <= MAX_TEMPLATE_BODY_SIZE:
+            return {"TemplateBody":template_body}
+        if not self.lambda_bucket_name:
+            raise RuntimeError("The template is too big to pass inline and there's no Lambda bucket to upload it to yet.  Set bootstrap_stack to create the buckets first.")
+        key = "templates/{stack_name}/{sha}.json".format(stack_name=self.stack_name, sha=hashlib.sha256(template_body.encode("utf-8")).hexdigest())
+        self._upload_template(key, template_body)
+        return {"TemplateURL":self._template_url(key)}
+
+    def _shard_template_url(self, shard_name, template):
+        body = canonicalize.compact_template_body(template)
+        key = "templates/{stack_name}/{shard_name}-{sha}.json".format(stack_name=self.stack_name, shard_name=shard_name, sha=hashlib.sha256(body.encode("utf-8")).hexdigest())
+        self.template_uploads[key] = body
+        return self._template_url(key)
+
+    def _deployed_shard_placement(self):
+        # Where everything in the deployed stack is: a shard index for whatever's in a nested stack, or None for the parent.
+        if not self._get_stack():
+            return {}
+        deployed = self._get_template_body_from_cf()
+        deployed = json.loads(deployed) if type(deployed) is str else deployed
+        placement = {name:None for name in deployed.get("Resources", {})}
+        placement.update(deployed.get("Metadata", {}).get(SHARD_METADATA_KEY, {}))
+        return placement
 
     def _delete_resource(self, resource):
         type = resource["Type"]
         service = type.split("::")[1]
         if type == "AWS::ApiGateway::BasePathMapping":
             logging.info("Manually deleting AWS::ApiGateway::BasePathMapping resource.")
-            logging.debug(boto3.client("apigateway").delete_base_path_mapping(domainName=resource["Properties"]["DomainName"], basePath=resource["Properties"]["BasePath"] if resource["Properties"]["BasePath"] else '""'))
+            logging.debug(self.client("apigateway").delete_base_path_mapping(domainName=resource["Properties"]["DomainName"], basePath=resource["Properties"]["BasePath"] if resource["Properties"]["BasePath"] else '""'))
         else:
             raise RuntimeError("Sunyata doesn't know how to delete resource type {type}".format(type=type))
 
@@ -272,40 +508,49 @@ class SunyataDeployer(object):
     def _make_raw_calls(self):
         for call in self.calls_to_make:
             service = call["service"]
-            client = boto3.client(service)
+            client = self.client(service)
             method_name = call["method"]
             method = getattr(client, method_name)
             params = self._fill_in_placeholder_params(call["params"])
-            print("Service: {}".format(service))
-            print("Method: {}".format(method_name))
-            print("Params: {}".format(params))
+            logging.info("Service: {}".format(service))
+            logging.info("Method: {}".format(method_name))
+            logging.info("Params: {}".format(params))
             response = method(**params)
-            print("Response: {}".format(response))
+            logging.info("Response: {}".format(response))
         self.calls_to_make = []
                 
+    def _require_success(self, succeeded, operation):
+        # Failed and rolled-back operations are only logged as they happen, so this is what makes them fail the deploy.
+        if not succeeded:
+            raise RuntimeError("{operation} stack {stack_name} failed: it finished in state {status}.".format(operation=operation, stack_name=self.stack_name, status=self.last_stack_status))
+
     def _create_stack(self):
         stack = self._get_stack()
         if stack and stack["StackStatus"] != "DELETE_COMPLETE":
+            self.last_stack_status = stack["StackStatus"]
             logging.warn("Stack {stack_name_or_id} already exists.".format(stack_name_or_id=self.stack_name_or_id))
-            return
-        cf = boto3.client("cloudformation")
+            return False
+        cf = self.client("cloudformation")
         template_body = canonicalize.compact_template_body(self.template)
         self.check_template(template_body)
         response = cf.create_stack(
             StackName=self.stack_name,
-            TemplateBody=template_body,
+            **self._template_args(template_body),
             Capabilities=["CAPABILITY_NAMED_IAM"],
             DisableRollback=True
         )
         self.stack_id = response["StackId"]
-        status = "CREATE_IN_PROGRESS"
-        while status.endswith("IN_PROGRESS"):
-            if status in ["CREATE_IN_PROGRESS", "UPDATE_IN_PROGRESS"]:
-                logging.debug("Stack in state {status}.  Waiting 5 seconds.".format(status=status))
-            else:
-                logging.info("Stack in state {status}.  Waiting 5 seconds.".format(status=status))
-            time.sleep(5)
-            status = self._get_stack()["StackStatus"]
+        return not stack_failed(self._wait_for_stack(last_event_id=None))
+
+    def _template_unchanged(self, old_template, new_template):
+        old_fingerprint = canonicalize.stored_fingerprint(old_template)
+        if old_fingerprint:
+            return old_fingerprint == canonicalize.stored_fingerprint(new_template)
+        # Stacks deployed before fingerprints were recorded can still be compared on everything but the volatile properties.
+        return canonicalize.template_fingerprint(old_template) == canonicalize.template_fingerprint(new_template)
+
+    def _unchanged_since_deploy(self):
+        return self.api.get("skip_unchanged_updates", True) and self._template_unchanged(self._get_template_body_from_cf(), self.template)
 
     def _same_resource_names(self, old_template, new_template):
         old_stack = old_template if type(old_template) == dict else json.loads(old_template)
@@ -313,101 +558,428 @@ class SunyataDeployer(object):
         return ",".join(sorted(old_stack["Resources"].keys())) == ",".join(sorted(new_stack["Resources"].keys()))
 
     def _update_stack(self):
-        cf = boto3.client("cloudformation")
+        # Returns whether the stack ended up on the new template, which it already is when nothing changed.
+        cf = self.client("cloudformation")
         template_body = canonicalize.compact_template_body(self.template)
         canonical_old_template = canonicalize.canonical_template_body(self._get_template_body_from_cf())
         canonical_new_template = canonicalize.canonical_template_body(template_body)
-#         if canonical_old_template == canonical_new_template:
-#             logging.info("No update necessary.")
-#             return
+        if self._unchanged_since_deploy():
+            logging.info("Template and bundles are unchanged since the last deploy.  No update necessary.")
+            return True
         # if self._same_resource_names(canonical_old_template, canonical_new_template):
         #     logging.info("Highly likely (but not fully guaranteed) that no update is necessary.")
         #     return
         self.check_template(template_body)
 #         self._handle_manual_pre_transition_steps(old_template=canonical_old_template, new_template=canonical_new_template)
+        if self.use_change_sets:
+            return self._update_stack_with_change_set(template_body)
+        last_event_id = self._latest_stack_event_id()
         response = cf.update_stack(
             StackName=self.stack_name_or_id,
-            TemplateBody=template_body,
+            **self._template_args(template_body),
+            Capabilities=["CAPABILITY_NAMED_IAM"]
+        )
+        self.stack_id = response["StackId"]
+        return not stack_failed(self._wait_for_stack(last_event_id=last_event_id))
+
+    def _update_stack_with_change_set(self, template_body):
+        for line in format_diff(diff_templates(self._get_template_body_from_cf(), template_body)):
+            logging.info(line)
+        last_event_id = self._latest_stack_event_id()
+        change_set_id = self._create_change_set(template_body)
+        if not change_set_id:
+            logging.info("Change set contains no changes.  No update necessary.")
+            return True
+        changes = self._describe_change_set(change_set_id)
+        for line in format_change_set(changes):
+            logging.info(line)
+        replacements = count_replacements(changes)
+        if replacements:
+            logging.warn("{count} of {total} changed resources may be replaced.".format(count=replacements, total=len(changes)))
+        self.client("cloudformation").execute_change_set(ChangeSetName=change_set_id)
+        return not stack_failed(self._wait_for_stack(last_event_id=last_event_id))
+
+    def _create_change_set(self, template_body):
+        # Returns the change set's ID, or None if CloudFormation found nothing to change.
+        cf = self.client("cloudformation")
+        response = cf.create_change_set(
+            StackName=self.stack_name_or_id,
+            ChangeSetName="sunyata-{time}".format(time=datetime.datetime.now().strftime("%Y%m%d%H%M%S")),
+            ChangeSetType="UPDATE",
+            **self._template_args(template_body),
             Capabilities=["CAPABILITY_NAMED_IAM"]
         )
         self.stack_id = response["StackId"]
-        status = "UPDATE_IN_PROGRESS"
-        while status.endswith("IN_PROGRESS"):
-            if status in ["CREATE_IN_PROGRESS", "UPDATE_IN_PROGRESS"]:
-                logging.debug("Stack in state {status}.  Waiting 5 seconds.".format(status=status))
+        change_set_id = response["Id"]
+        status = "CREATE_PENDING"
+        while status in ["CREATE_PENDING", "CREATE_IN_PROGRESS"]:
+            time.sleep(CHANGE_SET_POLL_DELAY)
+            change_set = cf.describe_change_set(ChangeSetName=change_set_id)
+            status = change_set["Status"]
+        if status == "FAILED":
+            reason = change_set.get("StatusReason", "")
+            cf.delete_change_set(ChangeSetName=change_set_id)
+            if any(no_change in reason for no_change in NO_CHANGE_REASONS):
+                return None
+            raise RuntimeError("Change set for {stack_name} failed: {reason}".format(stack_name=self.stack_name, reason=reason))
+        return change_set_id
+
+    def _describe_change_set(self, change_set_id):
+        changes = []
+        paginator = self.client("cloudformation").get_paginator("describe_change_set")
+        for page in paginator.paginate(ChangeSetName=change_set_id):
+            changes += [change["ResourceChange"] for change in page.get("Changes", []) if "ResourceChange" in change]
+        return changes
+
+    def _latest_stack_event_id(self, stack_name_or_id=None):
+        try:
+            events = self.client("cloudformation").describe_stack_events(StackName=stack_name_or_id if stack_name_or_id else self.stack_name_or_id)["StackEvents"]
+        except ClientError as e:
+            return None
+        return events[0]["EventId"] if events else None
+
+    def _new_stack_events(self, cf, seen, last_event_id, stack_name_or_id):
+        # Events come back newest first, so paging stops as soon as it reaches one that's already been handled or that predates this operation.
+        new_events = []
+        paginator = cf.get_paginator("describe_stack_events")
+        for page in paginator.paginate(StackName=stack_name_or_id):
+            for event in page["StackEvents"]:
+                if event["EventId"] in seen or event["EventId"] == last_event_id:
+                    return list(reversed(new_events))
+                new_events.append(event)
+        return list(reversed(new_events))
+
+    def _wait_for_stack(self, last_event_id=None, stack_name_or_id=None):
+        stack_name_or_id = stack_name_or_id if stack_name_or_id else self.stack_name_or_id
+        cf = self.client("cloudformation")
+        seen = set()
+        started = {}
+        durations = {}
+        delay = STACK_POLL_MIN_DELAY
+        status = None
+        while not status or status.endswith("IN_PROGRESS"):
+            new_events = self._new_stack_events(cf, seen, last_event_id, stack_name_or_id)
+            for event in new_events:
+                seen.add(event["EventId"])
+                logical_id = event["LogicalResourceId"]
+                resource_status = event["ResourceStatus"]
+                reason = event.get("ResourceStatusReason", None)
+                message = "{logical_id} ({type}): {status}{reason}".format(logical_id=logical_id, type=event["ResourceType"], status=resource_status, reason=" - " + reason if reason else "")
+                if "FAILED" in resource_status:
+                    logging.error(message)
+                else:
+                    logging.info(message)
+                if logical_id == event["StackName"] and event["ResourceType"] == "AWS::CloudFormation::Stack":
+                    status = resource_status
+                elif resource_status.endswith("IN_PROGRESS"):
+                    started.setdefault(logical_id, event["Timestamp"])
+                elif logical_id in started:
+                    durations[logical_id] = (event["Timestamp"] - started.pop(logical_id)).total_seconds()
+            if status and not status.endswith("IN_PROGRESS"):
+                break
+            # Poll quickly while things are happening and back off while they aren't, checking the stack itself whenever the backoff tops out in case an event was missed.
+            if new_events:
+                delay = STACK_POLL_MIN_DELAY
+            elif delay >= STACK_POLL_MAX_DELAY:
+                # A throttled or failed describe comes back as None, which just means checking again next time round.
+                stack = self._describe_stack(stack_name_or_id)
+                status = stack["StackStatus"] if stack else status
             else:
-                logging.info("Stack in state {status}.  Waiting 5 seconds.".format(status=status))
-            time.sleep(5)
-            status = self._get_stack()["StackStatus"]
+                delay = min(delay * 2, STACK_POLL_MAX_DELAY)
+            if not status or status.endswith("IN_PROGRESS"):
+                time.sleep(delay)
+        self.invalidate_stack_cache()
+        self.last_stack_status = status
+        if stack_failed(status):
+            logging.error("Stack {stack_name} finished in state {status}.".format(stack_name=stack_name_or_id, status=status))
+        else:
+            logging.info("Stack {stack_name} finished in state {status}.".format(stack_name=stack_name_or_id, status=status))
+        slowest = sorted([(durations[logical_id], logical_id) for logical_id in durations], reverse=True)[:SLOWEST_RESOURCES_REPORTED]
+        if slowest:
+            logging.info("Slowest resources: " + ", ".join(["{logical_id} ({seconds:.0f}s)".format(logical_id=logical_id, seconds=seconds) for seconds, logical_id in slowest]))
+        return status
+
+    def invalidate_stack_cache(self):
+        # Anything read from the stack is cached until this is called, which happens whenever a create or update finishes.
+        self._stack_cache = {}
+        if self.offline:
+            # Without credentials there's no stack to look at, so everything reads as though it hasn't been created yet.
+            self._stack_cache = {"stack":None, "bootstrap":None, "resources":StackResourceIndex(), "outputs":{}}
 
-    def _get_stack(self):
+    def _cached(self, name, fetch, refresh=False):
+        with self._stack_cache_lock:
+            if refresh or name not in self._stack_cache:
+                self._stack_cache[name] = fetch()
+            return self._stack_cache[name]
+
+    def _describe_stack(self, stack_name_or_id=None):
         try:
-            stacks = boto3.client("cloudformation").describe_stacks(StackName=self.stack_name_or_id)["Stacks"]
+            stacks = self.client("cloudformation").describe_stacks(StackName=stack_name_or_id if stack_name_or_id else self.stack_name_or_id)["Stacks"]
             if stacks:
                 return stacks[0]
         except Exception as e:
             pass
         return None
 
-    def get_logical_resource_from_cf(self, logical_name):
+    def _get_stack(self, refresh=False):
+        return self._cached("stack", self._describe_stack, refresh=refresh)
+
+    def _describe_stack_resources(self):
+        # describe_stack_resources stops at 100 resources, so this pages through list_stack_resources instead.
+        resources = []
         try:
-            resources = boto3.client("cloudformation").describe_stack_resources(StackName=self.stack_name_or_id)["StackResources"]
+            paginator = self.client("cloudformation").get_paginator("list_stack_resources")
+            for page in paginator.paginate(StackName=self.stack_name_or_id):
+                resources += page["StackResourceSummaries"]
         except ClientError as e:
-            return None
-        resources = [r for r in resources if r["LogicalResourceId"] == logical_name]
-        if resources:
-            return resources[0]
-        else:
-            return None
+            return StackResourceIndex()
+        return StackResourceIndex(resources)
+
+    def get_stack_resource_index(self):
+        return self._cached("resources", self._describe_stack_resources)
+
+    def get_logical_resource_from_cf(self, logical_name):
+        return self.get_stack_resource_index().get(logical_name)
 
     def get_deployments_from_cf(self):
-        resources = boto3.client("cloudformation").describe_stack_resources(StackName=self.stack_name_or_id)["StackResources"]
-        deployments = [r for r in resources if r["ResourceType"]=="AWS::ApiGateway::Deployment"]
-        return deployments
+        return self.get_stack_resource_index().of_type("AWS::ApiGateway::Deployment")
 
     def _get_template_body_from_cf(self):
-        return boto3.client("cloudformation").get_template(StackName=self.stack_name_or_id)["TemplateBody"]
+        return self._cached("template", lambda: self.client("cloudformation").get_template(StackName=self.stack_name_or_id)["TemplateBody"])
 
     def _get_stack_output(self, key):
-        stack = self._get_stack()
+        outputs = self._cached("outputs", self._describe_outputs)
+        return outputs.get(key, None)
+
+    def _describe_outputs(self, stack=None):
+        stack = stack if stack else self._get_stack()
         if not stack:
-            return None
-        matching = [o["OutputValue"] for o in stack.get("Outputs", []) if o["OutputKey"] == key]
-        if matching:
-            return matching[0]
-        return None
+            return {}
+        return {o["OutputKey"]:o["OutputValue"] for o in stack.get("Outputs", [])}
+
+    @property
+    def bootstrap_stack_name(self):
+        return "{stack_name}-bootstrap".format(stack_name=self.stack_name)
+
+    def _get_bootstrap_stack(self):
+        return self._cached("bootstrap", lambda: self._describe_stack(self.bootstrap_stack_name))
+
+    @property
+    def bootstrapped(self):
+        return self._get_bootstrap_stack() != None
+
+    def _get_infra_output(self, key):
+        if not self.bootstrapped:
+            return self._get_stack_output(key)
+        outputs = self._cached("bootstrap_outputs", lambda: self._describe_outputs(self._get_bootstrap_stack()))
+        return outputs.get(key, None)
+
+    def _ensure_bootstrap_stack(self):
+        # The bootstrap stack holds just the buckets, so code and static files can be uploaded before the API's own stack is created
+        # or updated.  It only gets an operation of its own when the buckets it needs change.
+        resources, outputs = self._infra_template()
+        template_body = canonicalize.compact_template_body(cfr.overall_template(resources=resources, outputs=outputs, description="Buckets for " + self.stack_name))
+        cf = self.client("cloudformation")
+        stack = self._get_bootstrap_stack()
+        if stack:
+            deployed = cf.get_template(StackName=stack["StackId"])["TemplateBody"]
+            if canonicalize.canonical_template_body(deployed) == canonicalize.canonical_template_body(template_body):
+                return
+            self.check_template(template_body)
+            last_event_id = self._latest_stack_event_id(stack["StackId"])
+            cf.update_stack(StackName=stack["StackId"], TemplateBody=template_body, Capabilities=["CAPABILITY_NAMED_IAM"])
+            self._wait_for_stack(last_event_id=last_event_id, stack_name_or_id=stack["StackId"])
+        else:
+            self.check_template(template_body)
+            response = cf.create_stack(StackName=self.bootstrap_stack_name, TemplateBody=template_body, Capabilities=["CAPABILITY_NAMED_IAM"], DisableRollback=True)
+            self._wait_for_stack(stack_name_or_id=response["StackId"])
 
     def _get_config(self):
         if not self.api.get("config_path", None):
             return None, {}
         configuration = {}
         configuration["static_file_url"] = self.static_s3_path
-        configuration["static_file_list"] = self.static_files
+        configuration["static_file_list"] = sorted(self.static_files)
+        configuration["static_file_manifest"] = self.static_manifest
         configuration["static_file_bucket"] = self.static_bucket_name
         configuration["base_url"] = self.get_url()
-        configuration["aws_account_id"] = boto3.client('sts').get_caller_identity().get('Account')
+        configuration["aws_account_id"] = self.client('sts').get_caller_identity().get('Account')
         configuration["aws_region"] = self.region
         configuration["stack_name"] = self.stack_name
         configuration.update(self.stage_config)
         return self.api["config_path"], configuration
 
     def _upload_static_files(self):
+        workers = self.api.get("static_upload_workers", DEFAULT_UPLOAD_WORKERS)
+        for directory in self.api.get("static_dirs",[]):
+            summary = sync_static(bucket=self.static_bucket_name, directory=directory, workers=workers, compression=self.api.get("static_compression", None), fingerprint=self.api.get("static_fingerprint", None), storage=self.storage, verify_attributes=self.api.get("static_verify_attributes", False))
+            self.static_files += summary.files
+            self.static_manifest.update(summary.manifest)
+
+    def _plan_static_files(self):
+        # Records the same static files and manifest _upload_static_files would, without uploading anything.
+        workers = self.api.get("static_upload_workers", DEFAULT_UPLOAD_WORKERS)
         for directory in self.api.get("static_dirs",[]):
-            self.static_files += upload_static(bucket=self.static_bucket_name, directory=directory)
+            plan = plan_static(directory, workers=workers, compression=self.api.get("static_compression", None), fingerprint=self.api.get("static_fingerprint", None))
+            self.static_files += plan.files
+            self.static_manifest.update(plan.manifest)
+
+    @property
+    def static_record_key(self):
+        return "static-files/{stack_name}.json".format(stack_name=self.stack_name)
+
+    def _deployed_static_files(self):
+        # The static keys the code from the last successful deploy referred to, as recorded in the Lambda bucket.
+        body = self.storage.get_object(self.lambda_bucket_name, self.static_record_key)
+        return json.loads(body.decode("utf-8")) if body else []
+
+    def _finish_static_files(self):
+        # Only called once the stack is running code that points at this deploy's static files.  Until then the old code is still
+        # serving pages that refer to the previous ones, and if the update rolls back it carries on doing so.
+        if not self.api.get("static_dirs", []):
+            return
+        previous = self._deployed_static_files()
+        self._prune_static_files(keep=self.static_files + previous)
+        deployed = sorted(set(self.static_files))
+        if deployed != previous:
+            self.storage.put_object(self.lambda_bucket_name, self.static_record_key, json.dumps(deployed).encode("utf-8"), content_type="application/json")
+
+    def _prune_static_files(self, keep):
+        # static_prune is either true, to delete objects that no longer exist locally, or "dry_run" to only report them.
+        # keep covers the previous deploy's files as well as this one's, for pages that were served before the update and are still open.
+        prune = self.api.get("static_prune", False)
+        if not prune:
+            return
+        dry_run = prune == "dry_run"
+        orphans = prune_static(bucket=self.static_bucket_name, keep=keep, dry_run=dry_run, storage=self.storage)
+        # Logged as warnings so the report shows up at the CLI's default log level; a dry run is pointless otherwise.
+        if dry_run:
+            logging.warning("Would delete {count} orphaned static files from {bucket}.".format(count=len(orphans), bucket=self.static_bucket_name))
+        else:
+            logging.warning("Deleted {count} orphaned static files from {bucket}.".format(count=len(orphans), bucket=self.static_bucket_name))
+        for key in orphans:
+            logging.warning("  {key}".format(key=key))
+
+    def _get_full_bundles(self):
+        # Maps each distinct bundle key to the function it's built from.
+        bundles = {}
+        for function in self.api["lambdas"]:
+            key = canonicalize.canonical_s3_key(file=function.get("file", None), directory=function.get("directory", None))
+            if not key in bundles:
+                bundles[key] = function
+        return bundles
+
+    def _get_bundles(self):
+        # The same as _get_full_bundles, but minus anything the shared layer provides.
+        bundles = self._get_full_bundles()
+        layer = self._get_shared_layer()
+        if layer:
+            bundles = {key:layer.strip(key, bundles[key]) for key in bundles}
+        return bundles
+
+    def _get_shared_layer(self):
+        if not self.api.get("shared_layer", False):
+            return None
+        if not self._shared_layer:
+            self._shared_layer = plan_shared_layer(self._get_full_bundles())
+            for name in sorted(self._shared_layer.packages.keys()):
+                logging.info("Moving shared package {name} into the shared layer.".format(name=name))
+        return self._shared_layer
+
+    def _upload_shared_layer(self):
+        layer = self._get_shared_layer()
+        if not layer or not layer.entries:
+            return
+        key = canonicalize.canonical_layer_s3_key("Shared")
+        logging.info("Uploading layer {key}".format(key=key))
+        with zip_entries(layer.entries, cache_dir=self.zip_cache_dir, compression=self.api.get("bundle_compression", None)) as fileobj:
+            self.lambda_keys[key], uploaded = upload_bundle(bucket=self.lambda_bucket_name, key=key, fileobj=fileobj, storage=self.storage)
 
     def _upload_lambda_code(self):
         bucket = self.lambda_bucket_name
         self.lambda_keys = {}
         config_path, config = self._get_config()
-        real_keys = {}
-        for function in self.api["lambdas"]:
-            key = canonicalize.canonical_s3_key(file=function.get("file", None), directory=function.get("directory", None))
-            if not key in real_keys:
-                logging.info("Uploading bundle {key}".format(key=key))
-                real_keys[key] = upload_lambda(function=function, bucket=bucket, key=key, config_path=config_path, config=config)
-            else:
-                logging.info("Bundle {key} already uploaded.  Skipping.".format(key=key))
-            self.lambda_keys[key] = real_keys[key]
+        bundles = self._get_bundles()
+        for key in sorted(bundles.keys()):
+            logging.info("Uploading bundle {key}".format(key=key))
+        self._upload_shared_layer()
+        real_keys = upload_lambdas(
+            bucket=bucket,
+            bundles=bundles,
+            config_path=config_path,
+            config=config,
+            build_workers=self.api.get("bundle_build_workers", None),
+            upload_workers=self.api.get("bundle_upload_workers", DEFAULT_UPLOAD_WORKERS),
+            cache_dir=self.zip_cache_dir,
+            compression=self.api.get("bundle_compression", None),
+            storage=self.storage
+        )
+        for key in real_keys:
+            full_key, uploaded = real_keys[key]
+            if not uploaded:
+                logging.info("Bundle {key} is unchanged, so its functions won't be updated.".format(key=key))
+            self.lambda_keys[key] = full_key
+        self._evict_zip_cache()
+
+    def _build_lambda_code(self):
+        self.lambda_keys = {}
+        config_path, config = self._get_config()
+        bundles = self._get_bundles()
+        for key in sorted(bundles.keys()):
+            logging.info("Building bundle {key}".format(key=key))
+        self._upload_shared_layer()
+        built = build_bundles(
+            bundles=bundles,
+            config_path=config_path,
+            config=config,
+            build_workers=self.api.get("bundle_build_workers", None),
+            cache_dir=self.zip_cache_dir,
+            compression=self.api.get("bundle_compression", None)
+        )
+        for key in built:
+            self.lambda_keys[key] = built_bundle_key(key, built[key])
+        self._evict_zip_cache()
+        return built
+
+    def _upload_built_lambda_code(self, built):
+        real_keys = upload_built_bundles(bucket=self.lambda_bucket_name, built=built, upload_workers=self.api.get("bundle_upload_workers", DEFAULT_UPLOAD_WORKERS), storage=self.storage)
+        for key in real_keys:
+            full_key, uploaded = real_keys[key]
+            if not uploaded:
+                logging.info("Bundle {key} is unchanged, so its functions won't be updated.".format(key=key))
+
+    def _generate_and_check(self):
+        # An update that's going to be skipped doesn't need its template validated either.
+        self.generate()
+        self.combine()
+        if not self._unchanged_since_deploy():
+            self.check_template(canonicalize.compact_template_body(self.template))
+
+    def _config_includes_static_files(self):
+        return bool(self.api.get("config_path", None)) and bool(self.api.get("static_dirs", []))
+
+    def _prefetch_stack_state(self):
+        # Everything the concurrent stages read from the stack is fetched up front, so they only ever hit the cache.
+        self._get_template_body_from_cf()
+        self.get_stack_resource_index()
+        self._bucket_name = self.lambda_bucket_name
+        if self.api.get("static_dirs", []):
+            self._static_bucket_name = self.static_bucket_name
+            self._static_url = self.static_s3_path
+        self._storage = self.storage
+
+    async def _prepare_update(self):
+        # Static sync runs alongside the bundle builds.  Once the bundles are built their keys are known, so the template is generated
+        # and validated while they upload.  Bundles only wait for the static sync when their config lists the static files.
+        loop = asyncio.get_running_loop()
+        self._prefetch_stack_state()
+        static = loop.run_in_executor(None, self._upload_static_files)
+        if self._config_includes_static_files():
+            await static
+        built = await loop.run_in_executor(None, self._build_lambda_code)
+        upload = loop.run_in_executor(None, self._upload_built_lambda_code, built)
+        await loop.run_in_executor(None, self._generate_and_check)
+        await asyncio.gather(static, upload)
 
     def get_current_template_body_from_cf(self):
         return canonicalize.canonical_template_body(self._get_template_body_from_cf())
@@ -417,6 +989,7 @@ class SunyataDeployer(object):
         self.cf_apis = {}
         self.cf_roles = {}
         self.cf_functions = {}
+        self.cf_layers = {}
         self.cf_permissions = {}
         self.cf_deployments = {}
         self.cf_resources = {}
@@ -435,20 +1008,32 @@ class SunyataDeployer(object):
         self.generate_resources_and_methods()
         self.generate_deployments()
 
-    def generate_infra(self):
-        self.cf_infra["LambdaZipBucket"] = cfr.bucket()
-        self.cf_outputs["LambdaZipBucket"] = {"Value" : {"Ref" : "LambdaZipBucket"}}
+    def _infra_template(self):
+        resources = {"LambdaZipBucket":cfr.bucket()}
+        outputs = {"LambdaZipBucket":{"Value" : {"Ref" : "LambdaZipBucket"}}}
         if self.api.get("static_dirs", None):
-            self.cf_infra["StaticFileBucket"] = cfr.bucket(cors=True,website=True)
-            self.cf_infra["StaticFileBucketPolicy"] = cfr.public_bucket_policy("StaticFileBucket")
-            self.cf_outputs["StaticURL"] = {"Value" : {"Fn::GetAtt":["StaticFileBucket","WebsiteURL"]}}
-            self.cf_outputs["StaticFileBucket"] = {"Value" : {"Ref" : "StaticFileBucket"}}
+            resources["StaticFileBucket"] = cfr.bucket(cors=True,website=True)
+            resources["StaticFileBucketPolicy"] = cfr.public_bucket_policy("StaticFileBucket")
+            outputs["StaticURL"] = {"Value" : {"Fn::GetAtt":["StaticFileBucket","WebsiteURL"]}}
+            outputs["StaticFileBucket"] = {"Value" : {"Ref" : "StaticFileBucket"}}
+        return resources, outputs
+
+    def generate_infra(self):
+        resources, outputs = self._infra_template()
+        if self.bootstrapped:
+            # The buckets live in the bootstrap stack, but their outputs are repeated here so the API's stack still describes everything.
+            for key in outputs:
+                self.cf_outputs[key] = {"Value" : self._get_infra_output(key)}
+        else:
+            self.cf_infra.update(resources)
+            self.cf_outputs.update(outputs)
 
     def generate_apis(self):
         api_name = self.api_name
         if self.api.get("stages", None):
             self.cf_apis[api_name] = cfr.api(api_name)
             self.cf_outputs["BaseApiUrl"] = {"Value" : { "Fn::Join" : [ "", [ "https://",{"Ref" : api_name},".execute-api.",{"Ref" : "AWS::Region"},".amazonaws.com"] ] }}
+            self.cf_outputs["RestApiId"] = {"Value" : {"Ref" : api_name}}
 
     def generate_roles(self):
         for raw_name in self.api["roles"]:
@@ -460,6 +1045,12 @@ class SunyataDeployer(object):
         self.lambda_functions = {}
         bucket = self.lambda_bucket_name
         function_arns = []
+        layer = self._get_shared_layer()
+        layer_name = canonicalize.canonical_layer_name("Shared")
+        if layer and layer.entries:
+            layer_ckey = canonicalize.canonical_layer_s3_key("Shared")
+            runtimes = sorted(set([function["runtime"] for function in self.api["lambdas"]]))
+            self.cf_layers[layer_name] = cfr.lambda_layer("Shared", runtimes, bucket, self.lambda_keys.get(layer_ckey, layer_ckey))
         for function in self.api["lambdas"]:
             name = function["name"]
             cfname = canonicalize.canonical_function_name(name)
@@ -474,7 +1065,8 @@ class SunyataDeployer(object):
             vpc_config = function.get("vpc_config", None)
             ckey = canonicalize.canonical_s3_key(file=function.get("file", None), directory=function.get("directory", None))
             key = self.lambda_keys.get(ckey, ckey)
-            self.cf_functions[cfname] = cfr.lambda_function(name, runtime, role, handler, description, timeout, memory, bucket, key, vpc_config=vpc_config)
+            layers = [{"Ref" : layer_name}] if layer and layer.uses_layer(ckey) else None
+            self.cf_functions[cfname] = cfr.lambda_function(name, runtime, role, handler, description, timeout, memory, bucket, key, vpc_config=vpc_config, layers=layers)
             self.cf_permissions[canonicalize.canonical_permissions_name(function["name"])] = cfr.lambda_permission(cfname)
         if self.api.get("stages", None):
             self.cf_roles["APIGWExecRole"] = cfr.apigateway_role(function_arns)
@@ -607,6 +1199,7 @@ class SunyataDeployer(object):
         self.resources.update(self.cf_stages)
         self.resources.update(self.cf_permissions)
         self.resources.update(self.cf_functions)
+        self.resources.update(self.cf_layers)
         self.resources.update(self.cf_roles)
         self.resources.update(self.cf_infra)
         for extra_template in self.extra_cf_templates:
@@ -619,6 +1212,23 @@ class SunyataDeployer(object):
             outputs=self.cf_outputs,
             description=self.api["description"]
         )
+        self.shard_templates = {}
+        self.template_uploads = {}
+        # Once an API passes shard_threshold, or has been sharded before, new paths go into nested stacks while deployed ones stay put.
+        # Nested stack templates live in the Lambda bucket, so an API can only be split up once that exists.
+        previous = self._deployed_shard_placement()
+        sharded = any([index != None for index in previous.values()])
+        if (sharded or len(self.resources) > self.api.get("shard_threshold", DEFAULT_SHARD_THRESHOLD)) and self.lambda_bucket_name:
+            self.template, self.shard_templates = shard_template(
+                self.template,
+                sorted(list(self.cf_resources.keys()) + list(self.cf_methods.keys())),
+                self._shard_template_url,
+                shard_size=self.api.get("shard_size", DEFAULT_SHARD_SIZE),
+                previous=previous
+            )
+        metadata = self.template.get("Metadata", {})
+        metadata[canonicalize.FINGERPRINT_METADATA_KEY] = canonicalize.template_fingerprint(self.template, self.lambda_keys)
+        self.template["Metadata"] = metadata
 
 #template_file = "simpleapi.json"
 #with open(template_file,"r") as f:
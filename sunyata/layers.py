@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import hashlib
+from sunyata.upload import function_bundle_entries
+from sunyata.zipcache import file_sha256
+
+# Python runtimes put /opt/python on the path, which is where a layer's contents get unpacked to.
+LAYER_PREFIX = "python/"
+
+PACKAGE_METADATA_SUFFIXES = [".dist-info", ".egg-info", ".libs"]
+
+class SharedLayer(object):
+    def __init__(self):
+        self.packages = {}
+        self.entries = []
+        self.users = {}
+
+    def uses_layer(self, key):
+        return key in self.users
+
+    def strip(self, key, function):
+        # Returns a copy of the function that leaves the packages it gets from the layer out of its own bundle.
+        if not self.uses_layer(key):
+            return function
+        stripped = dict(function)
+        stripped["exclude"] = list(function.get("exclude", [])) + ["/{name}/".format(name=name) for name in self.users[key]]
+        return stripped
+
+def package_directories(entries):
+    # Groups bundle entries by top-level directory, keeping only the ones that look like an installed package.
+    directories = {}
+    for arcname, path in entries:
+        if "/" in arcname:
+            directories.setdefault(arcname.split("/")[0], []).append((arcname, path))
+    packages = {}
+    for name in directories:
+        is_package = "{name}/__init__.py".format(name=name) in [arcname for arcname, path in directories[name]]
+        if is_package or any(name.endswith(suffix) for suffix in PACKAGE_METADATA_SUFFIXES):
+            packages[name] = directories[name]
+    return packages
+
+def package_hash(entries):
+    sha = hashlib.sha256()
+    for arcname, path in sorted(entries):
+        sha.update("{arcname}:{hash}\n".format(arcname=arcname, hash=file_sha256(path)).encode("utf-8"))
+    return sha.hexdigest()
+
+def plan_shared_layer(bundles):
+    # bundles maps each canonical key to the function it's built from, the same as for upload_lambdas.
+    # A package goes into the layer when at least two bundles carry byte-identical copies of it.  If bundles disagree on
+    # a package's contents, the copy shared by the most bundles wins and the rest keep bundling their own.
+    candidates = {}
+    for key in sorted(bundles.keys()):
+        function = bundles[key]
+        if not function.get("directory", None):
+            continue
+        packages = package_directories(function_bundle_entries(function))
+        for name in packages:
+            candidate = candidates.setdefault((name, package_hash(packages[name])), {"keys":[], "entries":packages[name]})
+            candidate["keys"].append(key)
+    chosen = {}
+    for name, content_hash in sorted(candidates.keys()):
+        candidate = candidates[(name, content_hash)]
+        if len(candidate["keys"]) < 2:
+            continue
+        if name not in chosen or len(candidate["keys"]) > len(chosen[name][1]["keys"]):
+            chosen[name] = (content_hash, candidate)
+    layer = SharedLayer()
+    for name in sorted(chosen.keys()):
+        content_hash, candidate = chosen[name]
+        layer.packages[name] = content_hash
+        layer.entries += [(LAYER_PREFIX + arcname, path) for arcname, path in candidate["entries"]]
+        for key in candidate["keys"]:
+            layer.users.setdefault(key, []).append(name)
+    layer.entries.sort()
+    return layer
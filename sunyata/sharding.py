@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+import re
+from sunyata import canonicalize
+
+# CloudFormation's per-template limits.
+MAX_TEMPLATE_BODY_SIZE = 51200
+MAX_STACK_RESOURCES = 500
+MAX_PARAMETERS = 200
+MAX_OUTPUTS = 200
+
+DEFAULT_SHARD_SIZE = 150
+# Past this many resources, new paths go into nested stacks instead of the parent.  It's well short of MAX_STACK_RESOURCES because
+# whatever is already deployed in the parent stays there.  Moving a resource into a nested stack makes CloudFormation create the new
+# copy before deleting the old one, and API Gateway rejects a second resource with the same path part or a second method on the same resource.
+DEFAULT_SHARD_THRESHOLD = 400
+SHARD_METADATA_KEY = "SunyataShards"
+
+PSEUDO_PARAMETERS = ["AWS::AccountId", "AWS::NotificationARNs", "AWS::NoValue", "AWS::Partition", "AWS::Region", "AWS::StackId", "AWS::StackName", "AWS::URLSuffix"]
+
+def _reference(value):
+    # Returns (logical id, attribute) for a Ref or Fn::GetAtt, with None as the attribute for a Ref, or None for anything else.
+    if isinstance(value, dict) and len(value) == 1:
+        if isinstance(value.get("Ref", None), str) and value["Ref"] not in PSEUDO_PARAMETERS:
+            return (value["Ref"], None)
+        if "Fn::GetAtt" in value:
+            target = value["Fn::GetAtt"]
+            return tuple(target.split(".", 1)) if isinstance(target, str) else tuple(target)
+    return None
+
+def _expression(reference):
+    name, attribute = reference
+    return {"Ref":name} if attribute == None else {"Fn::GetAtt":[name, attribute]}
+
+def find_references(value):
+    reference = _reference(value)
+    if reference:
+        return set([reference])
+    children = value.values() if isinstance(value, dict) else value if isinstance(value, list) else []
+    references = set()
+    for child in children:
+        references |= find_references(child)
+    return references
+
+def replace_references(value, replacements):
+    # replacements maps (logical id, attribute) pairs to whatever should stand in for that Ref or Fn::GetAtt.
+    reference = _reference(value)
+    if reference:
+        return replacements.get(reference, value)
+    if isinstance(value, dict):
+        return {k:replace_references(value[k], replacements) for k in value}
+    if isinstance(value, list):
+        return [replace_references(e, replacements) for e in value]
+    return value
+
+def _depends_on(resource):
+    depends_on = resource.get("DependsOn", [])
+    return [depends_on] if isinstance(depends_on, str) else list(depends_on)
+
+def _cross_stack_name(reference):
+    name, attribute = reference
+    return name + (re.sub("[^A-Za-z0-9]", "", attribute) if attribute else "")
+
+def _ancestors(name, resources):
+    # The chain of API Gateway resources from the top of the path down to the one name is, or is attached to.
+    chain = []
+    current = name
+    while current in resources and current not in chain:
+        resource = resources[current]
+        properties = resource.get("Properties", {})
+        if resource["Type"] == "AWS::ApiGateway::Resource":
+            chain.insert(0, current)
+            parent = _reference(properties.get("ParentId", None))
+        else:
+            parent = _reference(properties.get("ResourceId", None))
+        current = parent[0] if parent and parent[1] == None else None
+    return chain
+
+def _group(names, resources, shard_size, depth=1):
+    # Groups paths by the resource they hang off at depth, going a level deeper for any group that won't fit in one shard.
+    # Parents sort ahead of their children, so a group that has to be cut into chunks anyway only ever refers back to earlier chunks.
+    chains = {name:_ancestors(name, resources) for name in names}
+    groups = {}
+    for name in names:
+        chain = chains[name]
+        key = chain[min(depth, len(chain)) - 1] if chain else "rootResource"
+        groups.setdefault(key, []).append(name)
+    result = {}
+    for key in groups:
+        members = sorted(groups[key], key=lambda name: (len(chains[name]), resources[name]["Type"] != "AWS::ApiGateway::Resource", name))
+        if len(members) <= shard_size:
+            result[key] = members
+        elif any([len(chains[name]) > depth for name in members]):
+            result.update(_group(members, resources, shard_size, depth + 1))
+        else:
+            for i in range(0, len(members), shard_size):
+                result["{key}#{i}".format(key=key, i=i // shard_size)] = members[i:i+shard_size]
+    return result
+
+def _referenced_names(names, resources):
+    referenced = set()
+    for name in names:
+        referenced |= set([ref_name for ref_name, attribute in find_references(resources[name])])
+        referenced |= set(_depends_on(resources[name]))
+    return referenced
+
+def _group_order(groups, resources):
+    # Orders groups so every group comes after the ones it refers to.
+    group_of = {name:key for key in groups for name in groups[key]}
+    needs = {}
+    for key in groups:
+        needs[key] = set([group_of[name] for name in _referenced_names(groups[key], resources) if name in group_of]) - set([key])
+    ordered = []
+    while len(ordered) < len(groups):
+        ready = sorted([key for key in groups if key not in ordered and needs[key] <= set(ordered)])
+        if not ready:
+            raise RuntimeError("Paths can't be split into nested stacks without a circular dependency.")
+        ordered += ready
+    return ordered, needs
+
+def plan_shards(resources, names, shard_size=DEFAULT_SHARD_SIZE, previous={}):
+    # Returns {name: shard index} for everything in names that goes in a nested stack.  previous says where each already-deployed
+    # name is, as a shard index or None for the parent, and none of those move (see DEFAULT_SHARD_THRESHOLD).  New names are grouped
+    # by path, and each group goes in the first shard with room that isn't earlier than anything it refers to.
+    placement = {name:previous[name] for name in names if previous.get(name, None) != None}
+    sizes = {}
+    for name in placement:
+        sizes[placement[name]] = sizes.get(placement[name], 0) + 1
+    groups = _group([name for name in names if name not in previous], resources, shard_size)
+    ordered, needs = _group_order(groups, resources)
+    for key in ordered:
+        floor = max([placement[name] for name in _referenced_names(groups[key], resources) if name in placement] + [0])
+        size = len(groups[key])
+        index = floor
+        while sizes.get(index, 0) + size > shard_size:
+            index += 1
+        for name in groups[key]:
+            placement[name] = index
+        sizes[index] = sizes.get(index, 0) + size
+    return placement
+
+def shard_template(template, names, template_url, shard_size=DEFAULT_SHARD_SIZE, previous={}):
+    # Moves the resources in names that aren't already deployed in the parent out of template and into nested stacks.  template_url
+    # is called with each shard's name and template and returns the URL it'll be uploaded to.  References that cross stacks become
+    # shard parameters, filled in by the parent either directly or from another shard's outputs.  Returns the parent template and
+    # {shard name: shard template}.
+    resources = template["Resources"]
+    placement = plan_shards(resources, names, shard_size, previous)
+    location = {name:canonicalize.canonical_shard_name(placement[name]) for name in placement}
+    shard_names = sorted(set(location.values()))
+    shards = {shard:{"AWSTemplateFormatVersion":"2010-09-09", "Parameters":{}, "Resources":{}, "Outputs":{}} for shard in shard_names}
+    shard_parameters = {shard:{} for shard in shard_names}
+    shard_depends_on = {shard:set() for shard in shard_names}
+
+    def from_outside(reference, stack):
+        # What stack (a shard, or None for the parent) has to use to get at reference.
+        owner = location.get(reference[0], None)
+        if owner == stack:
+            return None
+        if owner == None:
+            return _expression(reference)
+        output_name = _cross_stack_name(reference)
+        shards[owner]["Outputs"][output_name] = {"Value":_expression(reference)}
+        return {"Fn::GetAtt":[owner, "Outputs." + output_name]}
+
+    for shard in shard_names:
+        members = [name for name in names if location.get(name, None) == shard]
+        replacements = {}
+        for name in members:
+            for reference in find_references(resources[name]):
+                value = from_outside(reference, shard)
+                if value == None:
+                    continue
+                parameter = _cross_stack_name(reference)
+                shards[shard]["Parameters"][parameter] = {"Type":"String"}
+                shard_parameters[shard][parameter] = value
+                replacements[reference] = {"Ref":parameter}
+        for name in members:
+            resource = replace_references(resources[name], replacements)
+            depends_on = _depends_on(resource)
+            if depends_on:
+                resource["DependsOn"] = [dependency for dependency in depends_on if location.get(dependency, None) == shard]
+                shard_depends_on[shard] |= set([location.get(dependency, dependency) for dependency in depends_on if location.get(dependency, None) != shard])
+                if not resource["DependsOn"]:
+                    del resource["DependsOn"]
+            shards[shard]["Resources"][name] = resource
+
+    parent = dict(template)
+    parent_replacements = {}
+    parent_resources = {}
+    for name in resources:
+        if name in location:
+            continue
+        for reference in find_references(resources[name]):
+            if reference[0] in location:
+                parent_replacements[reference] = from_outside(reference, None)
+    for reference in find_references(template.get("Outputs", {})):
+        if reference[0] in location:
+            parent_replacements[reference] = from_outside(reference, None)
+    for name in resources:
+        if name in location:
+            continue
+        resource = replace_references(resources[name], parent_replacements)
+        depends_on = _depends_on(resource)
+        if depends_on:
+            resource["DependsOn"] = sorted(set([location.get(dependency, dependency) for dependency in depends_on]))
+        parent_resources[name] = resource
+    for shard in shard_names:
+        if len(shards[shard]["Parameters"]) > MAX_PARAMETERS or len(shards[shard]["Outputs"]) > MAX_OUTPUTS:
+            raise RuntimeError("Nested stack {shard} needs more parameters or outputs than CloudFormation allows.  Try a smaller shard_size.".format(shard=shard))
+        parent_resources[shard] = {
+            "Type":"AWS::CloudFormation::Stack",
+            "Properties":{
+                "TemplateURL":template_url(shard, shards[shard]),
+                "Parameters":shard_parameters[shard]
+            }
+        }
+        if shard_depends_on[shard]:
+            parent_resources[shard]["DependsOn"] = sorted(shard_depends_on[shard] - set([shard]))
+    parent["Resources"] = parent_resources
+    parent["Outputs"] = replace_references(template.get("Outputs", {}), parent_replacements)
+    if len(parent_resources) > MAX_STACK_RESOURCES:
+        raise RuntimeError("Even with its paths split into nested stacks, the template has {count} resources.".format(count=len(parent_resources)))
+    parent["Metadata"] = dict(template.get("Metadata", {}))
+    parent["Metadata"][SHARD_METADATA_KEY] = placement
+    return parent, shards
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+from abc import ABC, abstractmethod
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import tempfile
+
+MULTIPART_CHUNK_SIZE = 8*1024*1024
+# S3 caps uploads at 10000 parts, so the transfer manager doubles the part size until a file fits.
+MAX_MULTIPART_PARTS = 10000
+
+def get_transfer_config():
+    return TransferConfig(multipart_threshold=MULTIPART_CHUNK_SIZE, multipart_chunksize=MULTIPART_CHUNK_SIZE)
+
+def multipart_part_size(size, part_size=MULTIPART_CHUNK_SIZE):
+    while size > part_size * MAX_MULTIPART_PARTS:
+        part_size *= 2
+    return part_size
+
+def body_digests(body, part_size=MULTIPART_CHUNK_SIZE, multipart=True):
+    # Returns the MD5 of the body and the ETag S3 will give it when it's uploaded with get_transfer_config(), or with put_object if multipart is False.
+    # Anything under the multipart threshold gets its plain MD5 as its ETag, as does any single PUT; anything else gets the MD5 of its parts' MD5s plus a part count.
+    view = memoryview(body)
+    md5 = hashlib.md5(view)
+    if not multipart or len(body) < MULTIPART_CHUNK_SIZE:
+        return md5.hexdigest(), md5.hexdigest()
+    part_size = multipart_part_size(len(body), part_size)
+    part_digests = [hashlib.md5(view[i:i+part_size]).digest() for i in range(0, len(body), part_size)]
+    etag = "{digest}-{count}".format(digest=hashlib.md5(b"".join(part_digests)).hexdigest(), count=len(part_digests))
+    return md5.hexdigest(), etag
+
+def file_digests(path, part_size=MULTIPART_CHUNK_SIZE):
+    # The file is memory-mapped rather than read, so hashing it doesn't pull the whole thing into this process's heap.
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return body_digests(b"", part_size)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return body_digests(mapped, part_size)
+
+def _extra_args(content_type=None, cache_control=None, content_encoding=None, metadata=None):
+    names = {"ContentType":content_type, "CacheControl":cache_control, "ContentEncoding":content_encoding, "Metadata":metadata}
+    return {name:names[name] for name in names if names[name] != None}
+
+class Storage(ABC):
+    # Everything the upload code needs from an object store.  Object attributes are content_type, cache_control, content_encoding
+    # and metadata; head_object returns them as ContentType, CacheControl, ContentEncoding and Metadata, plus an unquoted ETag and a Size.
+
+    @abstractmethod
+    def list_objects(self, bucket, prefix=""):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def head_object(self, bucket, key):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_object(self, bucket, key):
+        # Returns the object's body, or None if there's no such object.
+        raise NotImplementedError()
+
+    @abstractmethod
+    def put_object(self, bucket, key, body, **attributes):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def upload_fileobj(self, bucket, key, fileobj, **attributes):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def upload_file(self, bucket, key, path, **attributes):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def copy_object(self, bucket, source_key, key, **attributes):
+        # With no attributes the copy keeps the source's; with any, they replace the source's entirely.
+        raise NotImplementedError()
+
+    @abstractmethod
+    def delete_objects(self, bucket, keys):
+        # Returns (key, message) pairs for anything that couldn't be deleted.
+        raise NotImplementedError()
+
+class S3Storage(Storage):
+    def __init__(self, client):
+        self.client = client
+
+    def list_objects(self, bucket, prefix=""):
+        index = {}
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                index[obj["Key"]] = {"ETag":obj["ETag"].strip('"'), "Size":obj["Size"]}
+        return index
+
+    def head_object(self, bucket, key):
+        try:
+            response = self.client.head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code", None) in ["404", "NoSuchKey", "NotFound"]:
+                return None
+            raise e
+        return {
+            "ETag":response["ETag"].strip('"'),
+            "Size":response["ContentLength"],
+            "ContentType":response.get("ContentType", None),
+            "CacheControl":response.get("CacheControl", None),
+            "ContentEncoding":response.get("ContentEncoding", None),
+            "Metadata":response.get("Metadata", {})
+        }
+
+    def get_object(self, bucket, key):
+        try:
+            response = self.client.get_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code", None) in ["404", "NoSuchKey", "NotFound"]:
+                return None
+            raise e
+        return response["Body"].read()
+
+    def put_object(self, bucket, key, body, **attributes):
+        self.client.put_object(Bucket=bucket, Key=key, Body=body, **_extra_args(**attributes))
+
+    def upload_fileobj(self, bucket, key, fileobj, **attributes):
+        self.client.upload_fileobj(fileobj, bucket, key, ExtraArgs=_extra_args(**attributes), Config=get_transfer_config())
+
+    def upload_file(self, bucket, key, path, **attributes):
+        self.client.upload_file(path, bucket, key, ExtraArgs=_extra_args(**attributes), Config=get_transfer_config())
+
+    def copy_object(self, bucket, source_key, key, **attributes):
+        extra_args = _extra_args(**attributes)
+        if extra_args:
+            extra_args["MetadataDirective"] = "REPLACE"
+        self.client.copy(CopySource={"Bucket":bucket, "Key":source_key}, Bucket=bucket, Key=key, ExtraArgs=extra_args, Config=get_transfer_config())
+
+    def delete_objects(self, bucket, keys):
+        response = self.client.delete_objects(Bucket=bucket, Delete={"Objects":[{"Key":key} for key in keys], "Quiet":True})
+        return [(error["Key"], error.get("Message", error.get("Code", ""))) for error in response.get("Errors", [])]
+
+class LocalStorage(Storage):
+    # Keeps each bucket as a directory under root, with every object's attributes in a JSON sidecar under <bucket>.meta,
+    # and gives objects the same ETags S3 would.
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def _meta_path(self, bucket, key):
+        return os.path.join(self.root, bucket + ".meta", key + ".json")
+
+    def _write(self, path, write):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            os.remove(tmp_path)
+            raise e
+
+    def _write_meta(self, bucket, key, etag, attributes):
+        meta = {
+            "ETag":etag,
+            "Size":os.path.getsize(self._path(bucket, key)),
+            "ContentType":attributes.get("content_type", None),
+            "CacheControl":attributes.get("cache_control", None),
+            "ContentEncoding":attributes.get("content_encoding", None),
+            "Metadata":attributes.get("metadata", None) or {}
+        }
+        self._write(self._meta_path(bucket, key), lambda f: f.write(json.dumps(meta, sort_keys=True).encode("utf-8")))
+
+    def list_objects(self, bucket, prefix=""):
+        index = {}
+        bucket_root = os.path.join(self.root, bucket)
+        for root, dirs, files in os.walk(bucket_root):
+            for filename in files:
+                key = os.path.relpath(os.path.join(root, filename), bucket_root)
+                if key.startswith(prefix):
+                    meta = self.head_object(bucket, key)
+                    index[key] = {"ETag":meta["ETag"], "Size":meta["Size"]}
+        return index
+
+    def head_object(self, bucket, key):
+        if not os.path.exists(self._path(bucket, key)):
+            return None
+        try:
+            with open(self._meta_path(bucket, key), "r") as f:
+                return json.load(f)
+        except FileNotFoundError as e:
+            # Something dropped a file straight into the bucket directory, so it gets the same defaults S3 would give it.
+            return {"ETag":file_digests(self._path(bucket, key))[0], "Size":os.path.getsize(self._path(bucket, key)), "ContentType":"binary/octet-stream", "CacheControl":None, "ContentEncoding":None, "Metadata":{}}
+
+    def get_object(self, bucket, key):
+        if not os.path.exists(self._path(bucket, key)):
+            return None
+        with open(self._path(bucket, key), "rb") as f:
+            return f.read()
+
+    def put_object(self, bucket, key, body, **attributes):
+        # A single PUT always gets the plain MD5 as its ETag, however big it is.
+        self._write(self._path(bucket, key), lambda f: f.write(body))
+        self._write_meta(bucket, key, hashlib.md5(body).hexdigest(), attributes)
+
+    def upload_fileobj(self, bucket, key, fileobj, **attributes):
+        self._write(self._path(bucket, key), lambda f: shutil.copyfileobj(fileobj, f))
+        self._write_meta(bucket, key, file_digests(self._path(bucket, key))[1], attributes)
+
+    def upload_file(self, bucket, key, path, **attributes):
+        with open(path, "rb") as fileobj:
+            self.upload_fileobj(bucket, key, fileobj, **attributes)
+
+    def copy_object(self, bucket, source_key, key, **attributes):
+        source = self.head_object(bucket, source_key)
+        if source_key != key:
+            with open(self._path(bucket, source_key), "rb") as src:
+                self._write(self._path(bucket, key), lambda f: shutil.copyfileobj(src, f))
+        if not _extra_args(**attributes):
+            attributes = {"content_type":source["ContentType"], "cache_control":source["CacheControl"], "content_encoding":source["ContentEncoding"], "metadata":source["Metadata"]}
+        self._write_meta(bucket, key, source["ETag"], attributes)
+
+    def delete_objects(self, bucket, keys):
+        failed = []
+        for key in keys:
+            try:
+                os.remove(self._path(bucket, key))
+                if os.path.exists(self._meta_path(bucket, key)):
+                    os.remove(self._meta_path(bucket, key))
+            except Exception as e:
+                failed.append((key, str(e)))
+        return failed
+
+def get_storage(config, client=None):
+    # config is the template's storage setting: nothing for S3, or {"type": "local", "root": <directory>}.
+    config = config if config else {"type":"s3"}
+    if config.get("type", "s3") == "local":
+        return LocalStorage(config["root"])
+    if config.get("type", "s3") == "s3":
+        return S3Storage(client)
+    raise RuntimeError("Unknown storage type {type}.  Must be s3 or local.".format(type=config["type"]))
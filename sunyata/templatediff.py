@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import json
+
+# Lists whose order CloudFormation doesn't care about, so reordering them isn't a change.
+UNORDERED_KEYS = ["DependsOn"]
+
+def _load(template):
+    return json.loads(template) if type(template) is str else template
+
+def _changed_paths(old, new, path=""):
+    if type(old) != type(new) or not isinstance(old, (dict, list)):
+        return [] if old == new else [path]
+    if isinstance(old, list):
+        if len(old) != len(new):
+            return [path]
+        paths = []
+        for i in range(len(old)):
+            paths += _changed_paths(old[i], new[i], "{path}[{i}]".format(path=path, i=i))
+        return paths
+    paths = []
+    for key in sorted(set(old.keys()) | set(new.keys())):
+        child = path + "." + key if path else key
+        if key not in old or key not in new:
+            paths.append(child)
+        elif key in UNORDERED_KEYS and isinstance(old[key], list) and isinstance(new[key], list):
+            paths += [] if sorted(old[key]) == sorted(new[key]) else [child]
+        else:
+            paths += _changed_paths(old[key], new[key], child)
+    return paths
+
+def diff_templates(old_template, new_template):
+    # Returns one entry per resource that's added, removed or modified, with the paths of everything that changed on the modified ones.
+    # A resource whose type changes is always going to be replaced; anything else is only known once CloudFormation builds a change set.
+    old_resources = _load(old_template).get("Resources", {}) if old_template else {}
+    new_resources = _load(new_template).get("Resources", {})
+    changes = []
+    for logical_id in sorted(set(old_resources.keys()) | set(new_resources.keys())):
+        if logical_id not in old_resources:
+            changes.append({"logical_id":logical_id, "type":new_resources[logical_id]["Type"], "action":"Add", "paths":[]})
+        elif logical_id not in new_resources:
+            changes.append({"logical_id":logical_id, "type":old_resources[logical_id]["Type"], "action":"Remove", "paths":[]})
+        else:
+            paths = _changed_paths(old_resources[logical_id], new_resources[logical_id])
+            if paths:
+                type_changed = old_resources[logical_id]["Type"] != new_resources[logical_id]["Type"]
+                changes.append({"logical_id":logical_id, "type":new_resources[logical_id]["Type"], "action":"Replace" if type_changed else "Modify", "paths":paths})
+    return changes
+
+def format_diff(changes):
+    lines = []
+    for change in changes:
+        lines.append("{action:<8} {logical_id} ({type})".format(**change))
+        lines += ["           " + path for path in change["paths"]]
+    return lines
+
+def format_change_set(resource_changes):
+    # resource_changes are the ResourceChange entries from describe_change_set.
+    lines = []
+    for change in resource_changes:
+        action = change["Action"]
+        if action == "Modify":
+            replacement = change.get("Replacement", "False")
+            action = {"True":"Replace", "Conditional":"Replace?"}.get(replacement, "Update")
+        lines.append("{action:<8} {logical_id} ({type})".format(action=action, logical_id=change["LogicalResourceId"], type=change["ResourceType"]))
+    return lines
+
+def count_replacements(resource_changes):
+    return len([change for change in resource_changes if change["Action"] == "Modify" and change.get("Replacement", "False") != "False"])
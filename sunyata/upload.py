@@ -1,14 +1,30 @@
 #!/usr/bin/env python3
 
 import boto3
+from botocore.config import Config
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import datetime
+import fnmatch
+import gzip
 import hashlib
-import io
 import json
 import logging
+import multiprocessing
 import os
+import shutil
+import stat
 import sys
+import tempfile
 import zipfile
+import zlib
+from sunyata.bundlefilter import BundleFilter, bundle_entries
+from sunyata.storage import S3Storage, MULTIPART_CHUNK_SIZE, body_digests, file_digests
+from sunyata.zipcache import ZipEntryCache, write_cached_entry
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 content_types = {
 "jpg":"image/jpg",
@@ -33,15 +49,331 @@ content_types = {
 
 S3 = None
 
+DEFAULT_UPLOAD_WORKERS = 8
+# The most keys S3 will accept in a single DeleteObjects call.
+DELETE_BATCH_SIZE = 1000
+DEFAULT_CACHE_CONTROL = "max-age=60;s-maxage=3600"
+
+# Bundles smaller than this stay in memory; anything larger rolls over to a temp file on disk.
+BUNDLE_SPOOL_SIZE = 16*1024*1024
+
+# Every bundle entry gets the same timestamp and one of two permission sets, so identical sources always produce identical archives.
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+ZIP_FILE_MODE = 0o644
+ZIP_EXECUTABLE_MODE = 0o755
+
+COMPRESSION_METHODS = {
+"stored":zipfile.ZIP_STORED,
+"deflate":zipfile.ZIP_DEFLATED,
+}
+
+# Payloads that are already compressed gain nothing from another pass of deflate, so they're stored as-is.
+DEFAULT_COMPRESSION_POLICY = {
+"method":"deflate",
+"level":zlib.Z_DEFAULT_COMPRESSION,
+"min_size":0,
+"extensions":{ext:"stored" for ext in [".so", ".whl", ".egg", ".zip", ".jar", ".gz", ".tgz", ".bz2", ".xz", ".jpg", ".jpeg", ".png", ".gif", ".webp", ".woff", ".woff2", ".mp3", ".mp4"]},
+}
+
+# Compressed variants of static files are only used when they're at least min_savings smaller than the original.
+# brotli variants go to a separate <key>.br object.  Neither S3 website hosting nor a plain CloudFront distribution will ever serve
+# those on their own; something at the edge has to rewrite requests that accept br onto the .br key, so only turn it on with that in place.
+DEFAULT_STATIC_COMPRESSION = {
+"gzip":True,
+"brotli":False,
+"min_size":1024,
+"max_size":64*1024*1024,
+"min_savings":0.1,
+}
+
+# Fingerprinted names change whenever the content does, so those objects can be cached forever.
+DEFAULT_STATIC_FINGERPRINT = {
+"exclude":["*.html", "*.htm"],
+"cache_control":"public, max-age=31536000, immutable",
+"hash_length":12,
+}
+
+COMPRESSIBLE_CONTENT_TYPES = ["text/", "application/javascript", "application/json", "application/rtf", "image/svg+xml", "font/ttf", "application/x-font-otf", "application/vnd.ms-fontobject"]
+
+UPLOADED = "uploaded"
+SKIPPED = "skipped"
+RETAGGED = "retagged"
+
+class UploadSummary(object):
+    def __init__(self):
+        self.files = []
+        self.results = {}
+        self.manifest = {}
+
+    def record(self, key, result):
+        self.files.append(key)
+        self.results[key] = result
+
+    def keys_with_result(self, result):
+        return [key for key in self.files if self.results[key] == result]
+
+    @property
+    def uploaded(self):
+        return self.keys_with_result(UPLOADED)
+
+    @property
+    def skipped(self):
+        return self.keys_with_result(SKIPPED)
+
+    @property
+    def retagged(self):
+        return self.keys_with_result(RETAGGED)
+
+    def __str__(self):
+        return "{uploaded} uploaded, {skipped} skipped, {retagged} retagged".format(uploaded=len(self.uploaded), skipped=len(self.skipped), retagged=len(self.retagged))
+
+def get_s3_client(max_pool_connections=DEFAULT_UPLOAD_WORKERS):
+    # Clients are thread-safe, so a single one with a connection pool at least as large as the worker count is shared by every upload thread.
+    # Deployers hand their own S3Storage to everything they call, so this is only for callers without one.
+    global S3
+    S3 = S3 if S3 else boto3.client("s3", config=Config(max_pool_connections=max(max_pool_connections, 10)))
+    return S3
+
+def get_storage(storage=None, max_pool_connections=DEFAULT_UPLOAD_WORKERS):
+    # Everything defaults to S3 through the shared module-level client unless it's handed some other sunyata.storage.Storage.
+    return storage if storage else S3Storage(get_s3_client(max_pool_connections=max_pool_connections))
+
+class StaticObject(object):
+    def __init__(self, path_on_disk, key, content_type, content_encoding=None, cache_control=DEFAULT_CACHE_CONTROL, size=None, digests=None):
+        self.path_on_disk = path_on_disk
+        self.key = key
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+        self.cache_control = cache_control
+        # Encoded objects only keep the size and digests of their body, and encode it again from disk if it has to be uploaded,
+        # so a sync never holds more encoded bodies than it has workers.
+        self._size = size
+        self._digests = digests
+
+    @property
+    def size(self):
+        return self._size if self._size != None else os.path.getsize(self.path_on_disk)
+
+    @property
+    def streamed(self):
+        # Files big enough to go up in parts are streamed from disk rather than read into memory.
+        return self.content_encoding == None and self.size >= MULTIPART_CHUNK_SIZE
+
+    def digests(self):
+        if not self._digests:
+            # Encoded bodies always go up through put_object, so they only ever get a plain MD5 as their ETag.
+            self._digests = body_digests(self.read(), multipart=False) if self.content_encoding else file_digests(self.path_on_disk)
+        return self._digests
+
+    def md5(self):
+        return self.digests()[0]
+
+    def etag(self):
+        return self.digests()[1]
+
+    def read(self):
+        with open(self.path_on_disk, "rb") as f:
+            body = f.read()
+        return ENCODERS[self.content_encoding](body) if self.content_encoding else body
+
+class SyncPlan(object):
+    def __init__(self):
+        self.files = []
+        self.manifest = {}
+        self.to_upload = []
+        self.to_check = []
+        self.unchanged = []
+
+    def add(self, bucket_list, obj):
+        self.files.append(obj.key)
+        bucket_list.append(obj)
+
+def gzip_body(body):
+    # A fixed mtime keeps the output stable, so an unchanged file keeps matching the ETag of what's already in the bucket.
+    return gzip.compress(body, compresslevel=9, mtime=0)
+
+def brotli_body(body):
+    return brotli.compress(body)
+
+ENCODERS = {
+"gzip":gzip_body,
+"br":brotli_body,
+}
+
+def get_static_compression(compression):
+    if not compression:
+        return None
+    merged = dict(DEFAULT_STATIC_COMPRESSION)
+    if isinstance(compression, dict):
+        merged.update(compression)
+    if merged["brotli"] and not brotli:
+        logging.warning("Brotli compression of static files was requested but the brotli module isn't installed.  Skipping it.")
+        merged["brotli"] = False
+    return merged
+
+def get_static_fingerprint(fingerprint):
+    if not fingerprint:
+        return None
+    merged = dict(DEFAULT_STATIC_FINGERPRINT)
+    if isinstance(fingerprint, dict):
+        merged.update(fingerprint)
+    return merged
+
+def fingerprinted_key(key, path_on_disk, fingerprint):
+    if any(fnmatch.fnmatch(key, pattern) for pattern in fingerprint["exclude"]):
+        return key
+    root, ext = os.path.splitext(key)
+    return "{root}.{hash}{ext}".format(root=root, hash=file_md5(path_on_disk)[:fingerprint["hash_length"]], ext=ext)
+
+def is_compressible(content_type):
+    return any(content_type.startswith(t) for t in COMPRESSIBLE_CONTENT_TYPES)
+
+def _encode_if_smaller(body, encoding, compression):
+    encoded = ENCODERS[encoding](body)
+    if len(encoded) > len(body) * (1 - compression["min_savings"]):
+        return None
+    return encoded
+
+def _encoded_object(path_on_disk, key, content_type, encoding, encoded, cache_control):
+    return StaticObject(path_on_disk, key, content_type, encoding, cache_control=cache_control, size=len(encoded), digests=body_digests(encoded, multipart=False))
+
+def static_objects(path_on_disk, key, compression=None, fingerprint=None):
+    # The object at the file's own key is gzip-encoded when that's worthwhile, since every browser accepts gzip.
+    # Brotli isn't universally accepted, so it goes to a separate .br variant for a CDN to pick when the client asks for it.
+    # The encoded bodies are dropped as soon as they've been measured and hashed.
+    content_type = get_content_type(key, None)
+    cache_control = DEFAULT_CACHE_CONTROL
+    if fingerprint:
+        hashed_key = fingerprinted_key(key, path_on_disk, fingerprint)
+        if hashed_key != key:
+            key = hashed_key
+            cache_control = fingerprint["cache_control"]
+    size = os.path.getsize(path_on_disk)
+    if not compression or not is_compressible(content_type) or size < compression["min_size"] or size > compression["max_size"]:
+        return [StaticObject(path_on_disk, key, content_type, cache_control=cache_control)]
+    with open(path_on_disk, "rb") as f:
+        body = f.read()
+    gzipped = _encode_if_smaller(body, "gzip", compression) if compression["gzip"] else None
+    if gzipped:
+        objects = [_encoded_object(path_on_disk, key, content_type, "gzip", gzipped, cache_control)]
+    else:
+        objects = [StaticObject(path_on_disk, key, content_type, cache_control=cache_control)]
+    brotlied = _encode_if_smaller(body, "br", compression) if compression["brotli"] else None
+    if brotlied:
+        objects.append(_encoded_object(path_on_disk, key + ".br", content_type, "br", brotlied, cache_control))
+    return objects
+
+def _measured_static_objects(path_on_disk, key, compression=None, fingerprint=None):
+    objects = static_objects(path_on_disk, key, compression, fingerprint)
+    for obj in objects:
+        obj.digests()
+    return objects
+
+def list_bucket(bucket, prefix="", storage=None):
+    return get_storage(storage).list_objects(bucket, prefix)
+
+def file_md5(path):
+    return file_digests(path)[0]
+
+def is_multipart_etag(etag):
+    return "-" in etag
+
+def plan_static_sync(directory, index, compression=None, fingerprint=None, verify_attributes=False, workers=DEFAULT_UPLOAD_WORKERS):
+    # The listing only carries ETags, so an object whose bytes match is skipped even if its content-type, cache-control or encoding
+    # has drifted.  verify_attributes sends those through head_object instead, which retags any that are wrong.
+    # Files are hashed and encoded across worker threads; hashlib, zlib and brotli all release the GIL while they work.
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        paths += [os.path.join(root, filename) for filename in files]
+    plan = SyncPlan()
+    with ThreadPoolExecutor(max_workers=workers if workers else DEFAULT_UPLOAD_WORKERS) as executor:
+        logical_keys = [strip_prepath(path_on_disk, directory) for path_on_disk in paths]
+        all_objects = executor.map(_measured_static_objects, paths, logical_keys, [compression]*len(paths), [fingerprint]*len(paths))
+        for logical_key, objects in zip(logical_keys, all_objects):
+            if fingerprint:
+                plan.manifest[logical_key] = objects[0].key
+            for obj in objects:
+                existing = index.get(obj.key, None) if index != None else None
+                if index == None:
+                    # No listing available, so every object has to be checked individually.
+                    plan.add(plan.to_check, obj)
+                elif not existing or existing["Size"] != obj.size:
+                    plan.add(plan.to_upload, obj)
+                elif existing["ETag"] == obj.etag():
+                    plan.add(plan.to_check if verify_attributes else plan.unchanged, obj)
+                elif is_multipart_etag(existing["ETag"]):
+                    # A multipart ETag that doesn't match might just have been uploaded with different part sizes, so only the sunyata-md5 metadata can settle it.
+                    plan.add(plan.to_check, obj)
+                else:
+                    plan.add(plan.to_upload, obj)
+    return plan
+
 def get_content_type(fname, body):
     return content_types.get(fname.split(".")[-1].lower(),"binary/octet-stream")
 
-def zip_file(filename):
-    file_like_object = io.BytesIO()
+def new_bundle_file():
+    return tempfile.SpooledTemporaryFile(max_size=BUNDLE_SPOOL_SIZE, suffix=".zip")
+
+def get_compression_policy(policy=None):
+    # A policy only needs to list what it changes; extensions are merged over the defaults rather than replacing them.
+    policy = policy if policy else {}
+    merged = dict(DEFAULT_COMPRESSION_POLICY)
+    merged.update({k:policy[k] for k in policy if k != "extensions"})
+    merged["extensions"] = dict(DEFAULT_COMPRESSION_POLICY["extensions"])
+    merged["extensions"].update({ext.lower():policy.get("extensions", {})[ext] for ext in policy.get("extensions", {})})
+    return merged
+
+def get_compression(arcname, size, policy=None):
+    policy = policy if policy else DEFAULT_COMPRESSION_POLICY
+    rule = policy["extensions"].get(os.path.splitext(arcname)[1].lower(), {})
+    rule = {"method":rule} if isinstance(rule, str) else rule
+    method = rule.get("method", policy["method"])
+    level = rule.get("level", policy["level"])
+    if size < policy.get("min_size", 0):
+        method = "stored"
+    if method not in COMPRESSION_METHODS:
+        raise RuntimeError("Unknown compression method {method} for {arcname}.  Must be one of {methods}.".format(method=method, arcname=arcname, methods=", ".join(sorted(COMPRESSION_METHODS.keys()))))
+    return COMPRESSION_METHODS[method], level
+
+def normalize_arcname(arcname):
+    # The same normalization ZipFile.write() applies, so ./x.py and /abs/x.py go into the archive as x.py and abs/x.py.
+    arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+    while arcname[0] in (os.sep, os.altsep):
+        arcname = arcname[1:]
+    return arcname
+
+def zip_info(arcname, mode=ZIP_FILE_MODE, compress_type=zipfile.ZIP_DEFLATED, level=zlib.Z_DEFAULT_COMPRESSION):
+    zinfo = zipfile.ZipInfo(arcname, date_time=ZIP_DATE_TIME)
+    zinfo.create_system = 3
+    zinfo.external_attr = (stat.S_IFREG | mode) << 16
+    zinfo.compress_type = compress_type
+    # ZipFile.open() reads the level off the ZipInfo rather than taking it as an argument.  Python 3.13 renamed it from _compresslevel to compress_level.
+    if hasattr(zinfo, "compress_level"):
+        zinfo.compress_level = level
+    else:
+        zinfo._compresslevel = level
+    return zinfo
+
+def get_zip_cache(cache_dir):
+    return ZipEntryCache(cache_dir) if cache_dir else None
+
+def write_zip_entry(zipf, fname, arcname, cache=None, policy=None):
+    st = os.stat(fname)
+    executable = st.st_mode & stat.S_IXUSR
+    compress_type, level = get_compression(arcname, st.st_size, policy)
+    zinfo = zip_info(arcname, ZIP_EXECUTABLE_MODE if executable else ZIP_FILE_MODE, compress_type, level)
+    if cache and write_cached_entry(zipf, zinfo, cache.get_entry(fname, compress_type, level)):
+        return
+    with open(fname, "rb") as src, zipf.open(zinfo, "w") as dest:
+        shutil.copyfileobj(src, dest, 1024*1024)
+
+def zip_file(filename, fileobj=None, cache_dir=None, compression=None):
+    file_like_object = fileobj if fileobj else new_bundle_file()
     zipf = zipfile.ZipFile(file_like_object, 'w', zipfile.ZIP_DEFLATED)
-    zipf.write(filename)
+    write_zip_entry(zipf, filename, normalize_arcname(filename), cache=get_zip_cache(cache_dir), policy=get_compression_policy(compression))
     zipf.close()
-    return io.BytesIO(file_like_object.getvalue())
+    file_like_object.seek(0)
+    return file_like_object
 
 def strip_prepath(path, prepath):
     if path.startswith(prepath):
@@ -50,75 +382,280 @@ def strip_prepath(path, prepath):
         path = path[1:]
     return path
 
-def zip_directory(dirname, config_path=None, config=None):
-    file_like_object = io.BytesIO()
+def zip_directory(dirname, config_path=None, config=None, fileobj=None, cache_dir=None, compression=None, exclude=[], include=[]):
+    file_like_object = fileobj if fileobj else new_bundle_file()
+    cache = get_zip_cache(cache_dir)
+    policy = get_compression_policy(compression)
     zipf = zipfile.ZipFile(file_like_object, 'w', zipfile.ZIP_DEFLATED)
-    for root, dirs, files in os.walk(dirname):
-        arcpath = strip_prepath(root, dirname)
-        for file in files:
-            if file[-1] != "~":
-                fname = os.path.join(root, file)
-                arcname = os.path.join(arcpath, file)
-                zipf.write(fname, arcname)
+    for arcname, fname in bundle_entries(dirname, BundleFilter.for_directory(dirname, exclude=exclude, include=include)):
+        write_zip_entry(zipf, fname, arcname, cache=cache, policy=policy)
     if config_path:
         if config_path in zipf.namelist():
             raise RuntimeError("Requested config path {config_path} conflicts with a user-provided source file.".format(config_path=config_path))
         # Dump the config in as compressed a form as possible.
-        zipf.writestr(config_path, json.dumps(config, separators=(',',':')))
-        zipf.getinfo(config_path).external_attr = 0o777 << 16
+        config_body = json.dumps(config, separators=(',',':'), sort_keys=True).encode("utf-8")
+        zipf.writestr(zip_info(config_path, 0o777, *get_compression(config_path, len(config_body), policy)), config_body)
     zipf.close()
-    return io.BytesIO(file_like_object.getvalue())
+    file_like_object.seek(0)
+    return file_like_object
 
-def zip_function(function, config_path=None, config=None):
+def function_bundle_entries(function):
     if function.get("directory", None):
-        return zip_directory(function["directory"], config_path=config_path, config=config)
+        dirname = function["directory"]
+        return bundle_entries(dirname, BundleFilter.for_directory(dirname, exclude=function.get("exclude", []), include=function.get("include", [])))
+    else:
+        return [(normalize_arcname(function["file"]), function["file"])]
+
+def zip_entries(entries, fileobj=None, cache_dir=None, compression=None):
+    file_like_object = fileobj if fileobj else new_bundle_file()
+    cache = get_zip_cache(cache_dir)
+    policy = get_compression_policy(compression)
+    zipf = zipfile.ZipFile(file_like_object, 'w', zipfile.ZIP_DEFLATED)
+    for arcname, fname in sorted(entries):
+        write_zip_entry(zipf, fname, arcname, cache=cache, policy=policy)
+    zipf.close()
+    file_like_object.seek(0)
+    return file_like_object
+
+def zip_function(function, config_path=None, config=None, fileobj=None, cache_dir=None, compression=None):
+    # A compression policy on the function itself wins over the one passed in from the overall template.
+    compression = function.get("compression", compression)
+    if function.get("directory", None):
+        return zip_directory(function["directory"], config_path=config_path, config=config, fileobj=fileobj, cache_dir=cache_dir, compression=compression, exclude=function.get("exclude", []), include=function.get("include", []))
+    else:
+        return zip_file(function["file"], fileobj=fileobj, cache_dir=cache_dir, compression=compression)
+
+def build_bundle(function, config_path=None, config=None, cache_dir=None, compression=None):
+    # This runs in a worker process, so the bundle goes to a named file on disk that the parent can pick up.
+    fd, path = tempfile.mkstemp(suffix=".zip")
+    with os.fdopen(fd, "w+b") as f:
+        zip_function(function, config_path=config_path, config=config, fileobj=f, cache_dir=cache_dir, compression=compression)
+    return path
+
+def fileobj_md5(fileobj, chunk_size=1024*1024):
+    md5 = hashlib.md5()
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(chunk_size), b""):
+        md5.update(chunk)
+    fileobj.seek(0)
+    return md5.hexdigest()
+
+def upload_fileobj(bucket, key, fileobj, storage=None):
+    # Streams the file through S3's multipart transfer, so only a few chunks are ever held in memory.
+    storage = get_storage(storage)
+    md5 = fileobj_md5(fileobj)
+    utime=datetime.datetime.now().strftime("%Y-%m-%d-%H%M")
+    logging.debug("Streaming file to {bucket}/{key}".format(bucket=bucket, key=key))
+    storage.upload_fileobj(bucket, key, fileobj, **_object_attributes(get_content_type(key, None), DEFAULT_CACHE_CONTROL, None, md5, utime))
+    return md5
+
+def get_existing_md5(bucket, key, storage=None):
+    try:
+        existing = get_storage(storage).head_object(bucket, key)
+    except Exception as e:
+        return None
+    return existing["Metadata"].get("sunyata-md5", None) if existing else None
+
+def bundle_key(key, md5):
+    return "{key}.{md5}".format(key=key, md5=md5)
+
+def built_bundle_key(key, path):
+    with open(path, "rb") as fileobj:
+        return bundle_key(key, fileobj_md5(fileobj))
+
+def upload_bundle(bucket, key, fileobj, storage=None):
+    # Bundles are keyed by their content hash, so an unchanged bundle maps to an object that's already there and to an unchanged S3Key in the template.
+    storage = get_storage(storage)
+    md5 = fileobj_md5(fileobj)
+    full_key = bundle_key(key, md5)
+    if get_existing_md5(bucket, full_key, storage) == md5:
+        logging.info("Bundle {full_key} is unchanged.  Skipping upload.".format(full_key=full_key))
+        uploaded = False
     else:
-        return zip_file(function["file"])
+        upload_fileobj(bucket=bucket, key=full_key, fileobj=fileobj, storage=storage)
+        uploaded = True
+    if get_existing_md5(bucket, key, storage) != md5:
+        storage.copy_object(bucket, full_key, key)
+    return full_key, uploaded
+
+def _upload_built_bundle(bucket, key, path, storage=None):
+    try:
+        with open(path, "rb") as fileobj:
+            return upload_bundle(bucket=bucket, key=key, fileobj=fileobj, storage=storage)
+    finally:
+        os.remove(path)
+
+def build_context():
+    # Builds run alongside threads holding boto3 clients and locks, which a forked child would inherit mid-use.
+    return multiprocessing.get_context("spawn")
+
+def upload_lambdas(bucket, bundles, config_path=None, config=None, build_workers=None, upload_workers=DEFAULT_UPLOAD_WORKERS, cache_dir=None, compression=None, storage=None):
+    # Bundles are built in a process pool and each one is handed to the upload thread pool as soon as it's done.
+    # bundles maps each canonical key to the function definition it's built from.
+    if not bundles:
+        return {}
+    build_workers = build_workers if build_workers else min(len(bundles), os.cpu_count() or 1)
+    upload_workers = upload_workers if upload_workers else DEFAULT_UPLOAD_WORKERS
+    storage = get_storage(storage, max_pool_connections=upload_workers)
+    results = {}
+    with ProcessPoolExecutor(max_workers=build_workers, mp_context=build_context()) as builders, ThreadPoolExecutor(max_workers=upload_workers) as uploaders:
+        builds = {builders.submit(build_bundle, bundles[key], config_path, config, cache_dir, compression):key for key in bundles}
+        uploads = {}
+        for build in as_completed(builds):
+            key = builds[build]
+            logging.debug("Bundle {key} built.".format(key=key))
+            uploads[key] = uploaders.submit(_upload_built_bundle, bucket, key, build.result(), storage)
+        for key in uploads:
+            results[key] = uploads[key].result()
+    return results
+
+def build_bundles(bundles, config_path=None, config=None, build_workers=None, cache_dir=None, compression=None):
+    # The build half of upload_lambdas, for callers that want every bundle's key before any of them upload.
+    # Returns {key: path to the built bundle}; upload_built_bundles removes the files once they're uploaded.
+    if not bundles:
+        return {}
+    build_workers = build_workers if build_workers else min(len(bundles), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=build_workers, mp_context=build_context()) as builders:
+        builds = {builders.submit(build_bundle, bundles[key], config_path, config, cache_dir, compression):key for key in bundles}
+        return {builds[build]:build.result() for build in as_completed(builds)}
+
+def upload_built_bundles(bucket, built, upload_workers=DEFAULT_UPLOAD_WORKERS, storage=None):
+    if not built:
+        return {}
+    upload_workers = upload_workers if upload_workers else DEFAULT_UPLOAD_WORKERS
+    storage = get_storage(storage, max_pool_connections=upload_workers)
+    with ThreadPoolExecutor(max_workers=upload_workers) as uploaders:
+        uploads = {key:uploaders.submit(_upload_built_bundle, bucket, key, built[key], storage) for key in built}
+        return {key:uploads[key].result() for key in uploads}
 
-def upload_lambda(function, bucket, key, config_path=None, config=None):
-    fileobj = zip_function(function, config_path=config_path, config=config)
-    full_key = "{key}.{suffix}".format(key=key, suffix=datetime.datetime.now().strftime("%Y-%m-%d-%H%M"))
-    upload_body(bucket=bucket, key=full_key, body=fileobj.read())
-    S3.copy(CopySource={"Bucket":bucket, "Key":full_key}, Bucket=bucket, Key=key)
+def upload_lambda(function, bucket, key, config_path=None, config=None, cache_dir=None, compression=None, storage=None):
+    with zip_function(function, config_path=config_path, config=config, cache_dir=cache_dir, compression=compression) as fileobj:
+        full_key, uploaded = upload_bundle(bucket=bucket, key=key, fileobj=fileobj, storage=storage)
     return full_key
 
-def upload_static(bucket, directory):
-    files_uploaded = []
-    for root, dirs, files in os.walk(directory):
-        for filename in files:
-            path_on_disk = os.path.join(root, filename)
-            path_in_bucket = strip_prepath(path_on_disk, directory)
-            logging.debug("Uploading static file {fname}".format(fname=path_on_disk))
-            with open(path_on_disk, "rb") as f:
-                body = f.read()
-            if not upload_body(bucket=bucket, key=path_in_bucket, body=body):
-                logging.debug("File at {path_on_disk} already uploaded to {bucket}/{key}".format(path_on_disk=path_on_disk, bucket=bucket, key=path_in_bucket))
-            files_uploaded.append(path_in_bucket)
-    return files_uploaded
-
-def upload_body(bucket, key, body):
-    global S3
-    S3 = S3 if S3 else boto3.client("s3")
+def _upload_static_file(bucket, obj, check_existing=True, storage=None):
+    logging.debug("Uploading static file {fname}".format(fname=obj.path_on_disk))
+    if obj.streamed:
+        return _upload_streamed_file(bucket, obj, check_existing, storage)
+    body = obj.read()
+    if check_existing:
+        result = _upload_body(bucket=bucket, key=obj.key, body=body, content_type=obj.content_type, content_encoding=obj.content_encoding, cache_control=obj.cache_control, storage=storage)
+    else:
+        result = _put_body(bucket=bucket, key=obj.key, body=body, content_type=obj.content_type, content_encoding=obj.content_encoding, cache_control=obj.cache_control, storage=storage)
+    if result != UPLOADED:
+        logging.debug("File at {path_on_disk} already uploaded to {bucket}/{key}".format(path_on_disk=obj.path_on_disk, bucket=bucket, key=obj.key))
+    return result
+
+def _retag_if_present(storage, bucket, key, md5, etag, attributes):
+    # Returns None if the object has to be uploaded, or SKIPPED/RETAGGED if the right bytes are already there.
+    existing = storage.head_object(bucket, key)
+    if not existing:
+        return None
+    existing_md5 = existing["Metadata"].get("sunyata-md5", None)
+    if md5 != existing_md5 and etag != existing["ETag"]:
+        return None
+    # The correct bytes are already in the correct place
+    if attributes["content_type"] != existing["ContentType"] or md5 != existing_md5 or attributes["cache_control"] != existing["CacheControl"] or attributes.get("content_encoding", None) != existing["ContentEncoding"]:
+        # They're tagged with the wrong content-type.  Fix that or stuff doesn't work.
+        # Or maybe they're just missing the MD5 tag.  Go ahead and add that as the etag check isn't guaranteed to work.
+        storage.copy_object(bucket, key, key, **attributes)
+        return RETAGGED
+    return SKIPPED
+
+def _upload_streamed_file(bucket, obj, check_existing=True, storage=None):
+    storage = get_storage(storage)
+    md5 = obj.md5()
+    utime=datetime.datetime.now().strftime("%Y-%m-%d-%H%M")
+    attributes = _object_attributes(obj.content_type, obj.cache_control, obj.content_encoding, md5, utime)
+    if check_existing:
+        try:
+            result = _retag_if_present(storage, bucket, obj.key, md5, obj.etag(), attributes)
+            if result:
+                return result
+        except Exception as e:
+            logging.exception("Error while checking if file already uploaded: " + str(e))
+    logging.debug("Streaming file to {bucket}/{key}".format(bucket=bucket, key=obj.key))
+    storage.upload_file(bucket, obj.key, obj.path_on_disk, **attributes)
+    return UPLOADED
+
+def sync_static(bucket, directory, workers=DEFAULT_UPLOAD_WORKERS, compression=None, fingerprint=None, storage=None, verify_attributes=False):
+    workers = workers if workers else DEFAULT_UPLOAD_WORKERS
+    storage = get_storage(storage, max_pool_connections=workers)
+    try:
+        index = list_bucket(bucket, storage=storage)
+    except Exception as e:
+        logging.exception("Unable to list {bucket}; falling back to checking each object: {e}".format(bucket=bucket, e=str(e)))
+        index = None
+    plan = plan_static_sync(directory, index, get_static_compression(compression), get_static_fingerprint(fingerprint), verify_attributes, workers)
+    logging.debug("Sync plan for {directory}: {upload} to upload, {check} to check, {unchanged} unchanged".format(directory=directory, upload=len(plan.to_upload), check=len(plan.to_check), unchanged=len(plan.unchanged)))
+    results = {obj.key:SKIPPED for obj in plan.unchanged}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for obj in plan.to_upload:
+            futures.append((obj.key, executor.submit(_upload_static_file, bucket, obj, False, storage)))
+        for obj in plan.to_check:
+            futures.append((obj.key, executor.submit(_upload_static_file, bucket, obj, True, storage)))
+        for key, future in futures:
+            results[key] = future.result()
+    summary = UploadSummary()
+    summary.manifest = plan.manifest
+    for key in plan.files:
+        summary.record(key, results[key])
+    logging.warning("Static sync of {directory} to {bucket}: {summary}".format(directory=directory, bucket=bucket, summary=summary))
+    return summary
+
+def plan_static(directory, workers=DEFAULT_UPLOAD_WORKERS, compression=None, fingerprint=None):
+    # The keys and manifest sync_static would produce, worked out from the files alone without looking at or changing the bucket.
+    return plan_static_sync(directory, None, get_static_compression(compression), get_static_fingerprint(fingerprint), workers=workers)
+
+def find_orphans(index, keep):
+    keep = set(keep)
+    return sorted([key for key in index if key not in keep])
+
+def prune_static(bucket, keep, dry_run=False, storage=None):
+    # keep has to cover every static directory synced to the bucket, or files from the others will look orphaned.
+    storage = get_storage(storage)
+    orphans = find_orphans(list_bucket(bucket, storage=storage), keep)
+    if dry_run or not orphans:
+        return orphans
+    failed = []
+    for i in range(0, len(orphans), DELETE_BATCH_SIZE):
+        batch = orphans[i:i+DELETE_BATCH_SIZE]
+        logging.debug("Deleting {count} orphaned objects from {bucket}".format(count=len(batch), bucket=bucket))
+        for key, message in storage.delete_objects(bucket, batch):
+            logging.error("Unable to delete {bucket}/{key}: {message}".format(bucket=bucket, key=key, message=message))
+            failed.append(key)
+    if failed:
+        raise RuntimeError("Failed to delete {count} orphaned objects from {bucket}.".format(count=len(failed), bucket=bucket))
+    return orphans
+
+def upload_static(bucket, directory, workers=DEFAULT_UPLOAD_WORKERS, compression=None, fingerprint=None, storage=None):
+    return sync_static(bucket=bucket, directory=directory, workers=workers, compression=compression, fingerprint=fingerprint, storage=storage).files
+
+def upload_body(bucket, key, body, storage=None):
+    return _upload_body(bucket=bucket, key=key, body=body, storage=storage) == UPLOADED
+
+def _upload_body(bucket, key, body, content_type=None, content_encoding=None, cache_control=DEFAULT_CACHE_CONTROL, storage=None):
+    storage = get_storage(storage)
     md5=hashlib.md5(body).hexdigest()
     # I don't really care about this, but S3 requires a metadata change if an object is copied to itself, so including this guarantees that.
     utime=datetime.datetime.now().strftime("%Y-%m-%d-%H%M")
-    ct = get_content_type(key, body)
-    cc = "max-age=60;s-maxage=3600"
+    ct = content_type if content_type else get_content_type(key, body)
     try:
-        existing = S3.get_object(Bucket=bucket, Key=key, Range="bytes=0-0")
-        existing_md5 = existing.get("Metadata", {}).get("sunyata-md5", None)
-        existing_ct = existing["ContentType"]
-        existing_etag = existing["ETag"]
-        existing_cc = existing.get("CacheControl", None)
-        if md5 == existing_md5 or md5 == existing_etag:
-            # The correct bytes are already in the correct place
-            if ct != existing_ct or md5 != existing_md5 or cc != existing_cc:
-                # They're tagged with the wrong content-type.  Fix that or stuff doesn't work.
-                # Or maybe they're just missing the MD5 tag.  Go ahead and add that as the etag check isn't guaranteed to work.
-                S3.copy_object(Bucket=bucket, Key=key, Metadata={"sunyata-md5":md5,"utime":utime}, ContentType=ct, CopySource={"Bucket":bucket,"Key":key}, CacheControl=cc)
-            return False
+        result = _retag_if_present(storage, bucket, key, md5, md5, _object_attributes(ct, cache_control, content_encoding, md5, utime))
+        if result:
+            return result
     except Exception as e:
         logging.exception("Error while checking if file already uploaded: " + str(e))
+    return _put_body(bucket=bucket, key=key, body=body, md5=md5, content_type=ct, content_encoding=content_encoding, cache_control=cache_control, storage=storage)
+
+def _object_attributes(content_type, cache_control, content_encoding, md5, utime):
+    return {"content_type":content_type, "cache_control":cache_control, "content_encoding":content_encoding, "metadata":{"sunyata-md5":md5,"utime":utime}}
+
+def _put_body(bucket, key, body, md5=None, content_type=None, content_encoding=None, cache_control=DEFAULT_CACHE_CONTROL, storage=None):
+    md5 = md5 if md5 else hashlib.md5(body).hexdigest()
+    utime=datetime.datetime.now().strftime("%Y-%m-%d-%H%M")
+    ct = content_type if content_type else get_content_type(key, body)
     logging.debug("Uploading file to {bucket}/{key}".format(bucket=bucket, key=key))
-    S3.put_object(Bucket=bucket, Key=key, Body=body, ContentType=ct, Metadata={"sunyata-md5":md5,"utime":utime}, CacheControl=cc)
-    return True
+    get_storage(storage).put_object(bucket, key, body, **_object_attributes(ct, cache_control, content_encoding, md5, utime))
+    return UPLOADED
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import gzip
+import json
+import logging
+import os
+import re
+import urllib.request
+from sunyata.sharding import find_references
+
+DEFAULT_SPEC_PATH = os.path.join(os.path.expanduser("~"), ".cache", "sunyata", "CloudFormationResourceSpecification.json")
+DEFAULT_SPEC_URL = "https://d1uauaxba7bl26.cloudfront.net/latest/gzip/CloudFormationResourceSpecification.json"
+
+def _required(spec_type=None, **entry):
+    entry["Required"] = True
+    if spec_type:
+        entry["PrimitiveType"] = spec_type
+    return entry
+
+# Enough of the published resource specification to check the resource types sunyata itself generates, for when no copy of the real
+# one has been downloaded.  Nested property types aren't described, so only the top level of each resource gets checked against it.
+FALLBACK_SPEC = {
+    "ResourceTypes":{
+        "AWS::ApiGateway::BasePathMapping":{
+            "Properties":{"BasePath":{"PrimitiveType":"String"}, "DomainName":_required("String"), "RestApiId":{"PrimitiveType":"String"}, "Stage":{"PrimitiveType":"String"}}
+        },
+        "AWS::ApiGateway::Deployment":{
+            "Attributes":{"DeploymentId":{}},
+            "Properties":{"Description":{"PrimitiveType":"String"}, "RestApiId":_required("String"), "StageDescription":{}, "StageName":{"PrimitiveType":"String"}}
+        },
+        "AWS::ApiGateway::Method":{
+            "Attributes":{"MethodId":{}},
+            "Properties":{
+                "ApiKeyRequired":{"PrimitiveType":"Boolean"}, "AuthorizationType":{"PrimitiveType":"String"}, "HttpMethod":_required("String"), "Integration":{},
+                "MethodResponses":{"Type":"List"}, "RequestModels":{"Type":"Map", "PrimitiveItemType":"String"},
+                "RequestParameters":{"Type":"Map", "PrimitiveItemType":"Boolean"}, "ResourceId":_required("String"), "RestApiId":_required("String")
+            }
+        },
+        "AWS::ApiGateway::Model":{
+            "Properties":{"ContentType":{"PrimitiveType":"String"}, "Name":{"PrimitiveType":"String"}, "RestApiId":_required("String"), "Schema":{"PrimitiveType":"Json"}}
+        },
+        "AWS::ApiGateway::Resource":{
+            "Attributes":{"ResourceId":{}},
+            "Properties":{"ParentId":_required("String"), "PathPart":_required("String"), "RestApiId":_required("String")}
+        },
+        "AWS::ApiGateway::RestApi":{
+            "Attributes":{"RestApiId":{}, "RootResourceId":{}},
+            "Properties":{"Description":{"PrimitiveType":"String"}, "Name":{"PrimitiveType":"String"}, "Parameters":{"Type":"Map", "PrimitiveItemType":"String"}}
+        },
+        "AWS::ApiGateway::Stage":{
+            "Properties":{"CacheClusterEnabled":{"PrimitiveType":"Boolean"}, "DeploymentId":{"PrimitiveType":"String"}, "RestApiId":_required("String"), "StageName":{"PrimitiveType":"String"}}
+        },
+        "AWS::CloudFormation::Stack":{
+            "Properties":{"Parameters":{"Type":"Map", "PrimitiveItemType":"String"}, "TemplateURL":_required("String")}
+        },
+        "AWS::IAM::Role":{
+            "Attributes":{"Arn":{}, "RoleId":{}},
+            "Properties":{"AssumeRolePolicyDocument":_required("Json"), "Path":{"PrimitiveType":"String"}, "Policies":{"Type":"List"}}
+        },
+        "AWS::Lambda::Function":{
+            "Attributes":{"Arn":{}},
+            "Properties":{
+                "Code":_required(), "Description":{"PrimitiveType":"String"}, "Environment":{}, "FunctionName":{"PrimitiveType":"String"},
+                "Handler":{"PrimitiveType":"String"}, "Layers":{"Type":"List", "PrimitiveItemType":"String"}, "MemorySize":{"PrimitiveType":"Integer"},
+                "Role":_required("String"), "Runtime":{"PrimitiveType":"String"}, "Timeout":{"PrimitiveType":"Integer"}, "VpcConfig":{}
+            }
+        },
+        "AWS::Lambda::LayerVersion":{
+            "Attributes":{"LayerVersionArn":{}},
+            "Properties":{"CompatibleRuntimes":{"Type":"List", "PrimitiveItemType":"String"}, "Content":_required(), "Description":{"PrimitiveType":"String"}, "LayerName":{"PrimitiveType":"String"}}
+        },
+        "AWS::Lambda::Permission":{
+            "Properties":{"Action":_required("String"), "FunctionName":_required("String"), "Principal":_required("String"), "SourceAccount":{"PrimitiveType":"String"}, "SourceArn":{"PrimitiveType":"String"}}
+        },
+        "AWS::S3::Bucket":{
+            "Attributes":{"Arn":{}, "DomainName":{}, "DualStackDomainName":{}, "RegionalDomainName":{}, "WebsiteURL":{}},
+            "Properties":{"BucketName":{"PrimitiveType":"String"}, "CorsConfiguration":{}, "WebsiteConfiguration":{}}
+        },
+        "AWS::S3::BucketPolicy":{
+            "Properties":{"Bucket":_required("String"), "PolicyDocument":_required("Json")}
+        }
+    },
+    "PropertyTypes":{}
+}
+
+def load_resource_spec(path=DEFAULT_SPEC_PATH):
+    if path and os.path.exists(path):
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except Exception as e:
+            logging.warn("Couldn't read the resource specification at {path}, so falling back to the built-in one: {e}".format(path=path, e=e))
+    return FALLBACK_SPEC
+
+def fetch_resource_spec(url=DEFAULT_SPEC_URL, path=DEFAULT_SPEC_PATH):
+    with urllib.request.urlopen(url) as response:
+        data = response.read()
+    if data[:2] == b"\x1f\x8b":
+        data = gzip.decompress(data)
+    spec = json.loads(data.decode("utf-8"))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    return spec
+
+def _is_complete(spec):
+    # Only the downloaded specification lists every property and type, so only it can say a property or type doesn't exist.
+    return "ResourceSpecificationVersion" in spec
+
+def _is_intrinsic(value):
+    return isinstance(value, dict) and len(value) == 1 and (list(value.keys())[0] == "Ref" or list(value.keys())[0].startswith("Fn::"))
+
+def _primitive_error(value, primitive):
+    if primitive in ["Integer", "Long"]:
+        valid = (isinstance(value, int) and not isinstance(value, bool)) or (isinstance(value, str) and re.match(r"^-?\d+$", value))
+    elif primitive == "Double":
+        valid = (isinstance(value, (int, float)) and not isinstance(value, bool)) or (isinstance(value, str) and re.match(r"^-?\d+(\.\d+)?$", value))
+    elif primitive == "Boolean":
+        valid = isinstance(value, bool) or (isinstance(value, str) and value.lower() in ["true", "false"])
+    elif primitive == "Json":
+        valid = isinstance(value, (dict, str))
+    else:
+        # CloudFormation turns numbers and booleans into strings itself.
+        valid = not isinstance(value, (dict, list))
+    return None if valid else "expected {primitive}, got {value}".format(primitive=primitive, value=json.dumps(value))
+
+def _check_value(value, entry, resource_type, spec, path, errors, warnings):
+    if _is_intrinsic(value):
+        return
+    if entry.get("PrimitiveType", None):
+        error = _primitive_error(value, entry["PrimitiveType"])
+        if error:
+            errors.append("{path}: {error}".format(path=path, error=error))
+        return
+    container = entry.get("Type", None)
+    item_entry = {"PrimitiveType":entry["PrimitiveItemType"]} if entry.get("PrimitiveItemType", None) else {"Type":entry.get("ItemType", None)}
+    if container == "List":
+        if not isinstance(value, list):
+            errors.append("{path}: expected a list".format(path=path))
+            return
+        for i in range(len(value)):
+            _check_value(value[i], item_entry, resource_type, spec, "{path}[{i}]".format(path=path, i=i), errors, warnings)
+    elif container == "Map":
+        if not isinstance(value, dict):
+            errors.append("{path}: expected a map".format(path=path))
+            return
+        for key in value:
+            _check_value(value[key], item_entry, resource_type, spec, "{path}.{key}".format(path=path, key=key), errors, warnings)
+    elif container:
+        property_type = spec.get("PropertyTypes", {}).get("{resource_type}.{container}".format(resource_type=resource_type, container=container), None)
+        if property_type == None:
+            return
+        if not isinstance(value, dict):
+            errors.append("{path}: expected a {container}".format(path=path, container=container))
+            return
+        _check_properties(value, property_type.get("Properties", {}), resource_type, spec, path, errors, warnings)
+
+def _check_properties(properties, property_specs, resource_type, spec, path, errors, warnings):
+    for name in sorted(property_specs.keys()):
+        if property_specs[name].get("Required", False) and name not in properties:
+            errors.append("{path}: missing required property {name}".format(path=path, name=name))
+    for name in sorted(properties.keys()):
+        if name not in property_specs:
+            if _is_complete(spec):
+                warnings.append("{path}: unknown property {name}".format(path=path, name=name))
+            continue
+        _check_value(properties[name], property_specs[name], resource_type, spec, "{path}.{name}".format(path=path, name=name), errors, warnings)
+
+def validate_template(template, spec=FALLBACK_SPEC, warnings=None):
+    # Returns a list of problems with the template, empty if it looks deployable.  Checks each resource's properties against the
+    # resource specification, and that everything a Ref, Fn::GetAtt or DependsOn points at exists.
+    # Properties and resource types the specification doesn't know about only go in warnings, if that's given: CloudFormation accepts
+    # some that aren't listed (sunyata's own deployments set StageDescription.StageName), and the specification lags behind new ones.
+    warnings = warnings if warnings != None else []
+    template = json.loads(template) if type(template) is str else template
+    resources = template.get("Resources", {})
+    parameters = template.get("Parameters", {})
+    resource_specs = spec.get("ResourceTypes", {})
+    errors = []
+    for logical_id in sorted(resources.keys()):
+        resource = resources[logical_id]
+        resource_type = resource.get("Type", None)
+        if not resource_type:
+            errors.append("{logical_id}: missing Type".format(logical_id=logical_id))
+            continue
+        if resource_type in resource_specs:
+            _check_properties(resource.get("Properties", {}), resource_specs[resource_type].get("Properties", {}), resource_type, spec, logical_id, errors, warnings)
+        elif _is_complete(spec) and not resource_type.startswith("Custom::") and resource_type != "AWS::CloudFormation::CustomResource":
+            warnings.append("{logical_id}: unknown resource type {resource_type}".format(logical_id=logical_id, resource_type=resource_type))
+        depends_on = resource.get("DependsOn", [])
+        for dependency in [depends_on] if isinstance(depends_on, str) else depends_on:
+            if dependency not in resources:
+                errors.append("{logical_id}: DependsOn {dependency}, which isn't in the template".format(logical_id=logical_id, dependency=dependency))
+    for section in ["Resources", "Outputs"]:
+        for logical_id in sorted(template.get(section, {}).keys()):
+            for name, attribute in sorted(find_references(template[section][logical_id]), key=lambda reference: (reference[0], reference[1] or "")):
+                if attribute == None:
+                    if name not in resources and name not in parameters:
+                        errors.append("{logical_id}: Ref to {name}, which isn't a resource or parameter".format(logical_id=logical_id, name=name))
+                elif name not in resources:
+                    errors.append("{logical_id}: Fn::GetAtt on {name}, which isn't a resource".format(logical_id=logical_id, name=name))
+                else:
+                    target_type = resources[name].get("Type", None)
+                    attributes = resource_specs.get(target_type, {}).get("Attributes", None)
+                    nested_output = target_type == "AWS::CloudFormation::Stack" and attribute.startswith("Outputs.")
+                    if attributes != None and attribute not in attributes and not nested_output:
+                        errors.append("{logical_id}: Fn::GetAtt on {name}, which has no attribute {attribute}".format(logical_id=logical_id, name=name, attribute=attribute))
+    return errors
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import zipfile
+import zlib
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "sunyata", "zip")
+# Every edited revision of a file adds an entry, so the least recently used ones are dropped once the cache grows past this.
+DEFAULT_CACHE_MAX_SIZE = 512*1024*1024
+
+CHUNK_SIZE = 1024*1024
+
+def _atomic_write(path, write):
+    # Several bundle builds can share the cache at once, so files only ever appear fully written.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        os.remove(tmp_path)
+        raise e
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+class ZipEntryCache(object):
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.index_dir = os.path.join(cache_dir, "index")
+        self.entry_dir = os.path.join(cache_dir, "entries")
+        os.makedirs(self.index_dir, exist_ok=True)
+        os.makedirs(self.entry_dir, exist_ok=True)
+
+    def _index_path(self, path):
+        return os.path.join(self.index_dir, hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest() + ".json")
+
+    def content_hash(self, path):
+        # The content hash is only recomputed when the file's size or mtime has moved since it was last seen.
+        st = os.stat(path)
+        index_path = self._index_path(path)
+        try:
+            with open(index_path, "r") as f:
+                indexed = json.load(f)
+            if indexed["size"] == st.st_size and indexed["mtime"] == st.st_mtime_ns:
+                return indexed["sha256"]
+        except Exception as e:
+            pass
+        sha = file_sha256(path)
+        indexed = {"path":os.path.abspath(path), "size":st.st_size, "mtime":st.st_mtime_ns, "sha256":sha}
+        _atomic_write(index_path, lambda f: f.write(json.dumps(indexed).encode("utf-8")))
+        return sha
+
+    def get_entry(self, path, compress_type=zipfile.ZIP_DEFLATED, level=zlib.Z_DEFAULT_COMPRESSION):
+        sha = self.content_hash(path)
+        entry_name = "{sha}-{compress_type}-{level}".format(sha=sha, compress_type=compress_type, level=level)
+        meta_path = os.path.join(self.entry_dir, entry_name + ".json")
+        data_path = os.path.join(self.entry_dir, entry_name) if compress_type == zipfile.ZIP_DEFLATED else path
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            if compress_type != zipfile.ZIP_DEFLATED or os.path.exists(data_path):
+                # The metadata's mtime is when the entry was last used, which is what eviction goes by.
+                os.utime(meta_path)
+                meta["data_path"] = data_path
+                return meta
+        except Exception as e:
+            pass
+        logging.debug("Compressing {path} into the zip cache.".format(path=path))
+        meta = {"crc":0, "file_size":0, "compress_size":0}
+        def write_data(out):
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            with open(path, "rb") as src:
+                for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+                    meta["crc"] = zlib.crc32(chunk, meta["crc"])
+                    meta["file_size"] += len(chunk)
+                    if out:
+                        compressed = compressor.compress(chunk)
+                        meta["compress_size"] += len(compressed)
+                        out.write(compressed)
+            if out:
+                compressed = compressor.flush()
+                meta["compress_size"] += len(compressed)
+                out.write(compressed)
+            else:
+                meta["compress_size"] = meta["file_size"]
+        if compress_type == zipfile.ZIP_DEFLATED:
+            _atomic_write(data_path, write_data)
+        else:
+            write_data(None)
+        _atomic_write(meta_path, lambda f: f.write(json.dumps(meta).encode("utf-8")))
+        meta["data_path"] = data_path
+        return meta
+
+    def evict(self, max_size=DEFAULT_CACHE_MAX_SIZE):
+        # Drops the least recently used entries until the cache fits in max_size, and forgets files that no longer exist.
+        # Anything still being written is under a temp name and gets left alone.
+        entries = {}
+        for filename in os.listdir(self.entry_dir):
+            if filename.startswith("tmp"):
+                continue
+            path = os.path.join(self.entry_dir, filename)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError as e:
+                continue
+            name = filename[:-len(".json")] if filename.endswith(".json") else filename
+            entry = entries.setdefault(name, {"size":0, "used":0, "paths":[]})
+            entry["size"] += st.st_size
+            entry["paths"].append(path)
+            if filename.endswith(".json"):
+                entry["used"] = st.st_mtime
+        total = sum([entries[name]["size"] for name in entries])
+        for name in sorted(entries.keys(), key=lambda name: entries[name]["used"]):
+            if total <= max_size:
+                break
+            for path in entries[name]["paths"]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError as e:
+                    pass
+            total -= entries[name]["size"]
+        for filename in os.listdir(self.index_dir):
+            if filename.startswith("tmp"):
+                continue
+            index_path = os.path.join(self.index_dir, filename)
+            try:
+                with open(index_path, "r") as f:
+                    indexed = json.load(f)
+                if not os.path.exists(indexed["path"]):
+                    os.remove(index_path)
+            except Exception as e:
+                pass
+
+def evict_cache(cache_dir, max_size=DEFAULT_CACHE_MAX_SIZE):
+    if cache_dir and os.path.isdir(cache_dir):
+        ZipEntryCache(cache_dir).evict(max_size)
+
+# The ZipFile internals write_cached_entry relies on.  They're private, so anything without them just gets ZipFile.open() instead.
+ZIPFILE_INTERNALS = ["fp", "start_dir", "filelist", "NameToInfo", "_writecheck", "_didModify"]
+
+def write_cached_entry(zipf, zinfo, entry):
+    # zipfile has no public way to add data that's already compressed, so this does what ZipFile.open(zinfo, "w") does but copies the cached bytes straight in.
+    # Returns False, leaving the archive untouched, if the ZipFile lacks the internals this needs or the entry has since been evicted.
+    if not all([hasattr(zipf, name) for name in ZIPFILE_INTERNALS]):
+        return False
+    try:
+        src = open(entry["data_path"], "rb")
+    except FileNotFoundError as e:
+        return False
+    with src:
+        zinfo.CRC = entry["crc"]
+        zinfo.file_size = entry["file_size"]
+        zinfo.compress_size = entry["compress_size"]
+        zinfo.flag_bits = 0x00
+        zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+        zipf.fp.seek(zipf.start_dir)
+        zinfo.header_offset = zipf.fp.tell()
+        zipf._writecheck(zinfo)
+        zipf._didModify = True
+        zipf.fp.write(zinfo.FileHeader(zip64))
+        shutil.copyfileobj(src, zipf.fp, CHUNK_SIZE)
+    zipf.start_dir = zipf.fp.tell()
+    zipf.filelist.append(zinfo)
+    zipf.NameToInfo[zinfo.filename] = zinfo
+    return True
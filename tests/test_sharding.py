@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import unittest
+from sunyata import canonicalize
+from sunyata.sharding import find_references, plan_shards, shard_template, SHARD_METADATA_KEY
+
+def api_resource(path_part, parent):
+    return {"Type":"AWS::ApiGateway::Resource", "Properties":{"ParentId":parent, "PathPart":path_part, "RestApiId":{"Ref":"Api"}}}
+
+def api_method(resource, depends_on=None):
+    method = {
+        "Type":"AWS::ApiGateway::Method",
+        "Properties":{
+            "HttpMethod":"GET",
+            "ResourceId":{"Ref":resource},
+            "RestApiId":{"Ref":"Api"},
+            "Integration":{"Uri":{"Fn::GetAtt":["Handler", "Arn"]}}
+        }
+    }
+    if depends_on:
+        method["DependsOn"] = depends_on
+    return method
+
+def build_template(tops=3, children=2):
+    # /top<i>/child<j>, with a GET on every resource, plus the API, a function and a deployment that depends on every method.
+    resources = {
+        "Api":{"Type":"AWS::ApiGateway::RestApi", "Properties":{"Name":"Test"}},
+        "Handler":{"Type":"AWS::Lambda::Function", "Properties":{"Code":{}, "Role":"role"}}
+    }
+    names = []
+    for i in range(tops):
+        top = "Top{i}".format(i=i)
+        resources[top] = api_resource(top, {"Fn::GetAtt":["Api", "RootResourceId"]})
+        resources[top + "GET"] = api_method(top)
+        names += [top, top + "GET"]
+        for j in range(children):
+            child = "{top}Child{j}".format(top=top, j=j)
+            resources[child] = api_resource(child, {"Ref":top})
+            resources[child + "GET"] = api_method(child)
+            names += [child, child + "GET"]
+    resources["Deployment"] = {
+        "Type":"AWS::ApiGateway::Deployment",
+        "DependsOn":sorted([name for name in names if name.endswith("GET")]),
+        "Properties":{"RestApiId":{"Ref":"Api"}, "StageName":"prod"}
+    }
+    template = {
+        "AWSTemplateFormatVersion":"2010-09-09",
+        "Resources":resources,
+        "Outputs":{"RestApiId":{"Value":{"Ref":"Api"}}, "Top0Id":{"Value":{"Ref":"Top0"}}}
+    }
+    return template, sorted(names)
+
+def shard(template, names, shard_size=4, previous={}):
+    urls = {}
+    def template_url(shard_name, shard_template):
+        urls[shard_name] = shard_template
+        return "https://bucket/" + shard_name
+    parent, shards = shard_template(template, names, template_url, shard_size=shard_size, previous=previous)
+    return parent, shards, urls
+
+class TestPlanShards(unittest.TestCase):
+    def setUp(self):
+        canonicalize.set_api("Test")
+
+    def test_shards_stay_within_size(self):
+        template, names = build_template()
+        placement = plan_shards(template["Resources"], names, shard_size=4)
+        self.assertEqual(set(placement.keys()), set(names))
+        for index in set(placement.values()):
+            self.assertLessEqual(len([name for name in placement if placement[name] == index]), 4)
+
+    def test_groups_come_after_what_they_refer_to(self):
+        template, names = build_template()
+        resources = template["Resources"]
+        placement = plan_shards(resources, names, shard_size=4)
+        for name in names:
+            for ref_name, attribute in find_references(resources[name]):
+                if ref_name in placement:
+                    self.assertLessEqual(placement[ref_name], placement[name])
+
+    def test_deployed_names_never_move(self):
+        template, names = build_template()
+        previous = {"Top0":None, "Top0GET":None, "Top1":2, "Top1GET":2, "Api":None}
+        placement = plan_shards(template["Resources"], names, shard_size=4, previous=previous)
+        self.assertNotIn("Top0", placement)
+        self.assertNotIn("Top0GET", placement)
+        self.assertEqual(placement["Top1"], 2)
+        self.assertEqual(placement["Top1GET"], 2)
+        # Anything under Top1 has to go in Top1's shard or a later one.
+        self.assertGreaterEqual(placement["Top1Child0"], 2)
+
+class TestShardTemplate(unittest.TestCase):
+    def setUp(self):
+        canonicalize.set_api("Test")
+
+    def assertResolves(self, parent, shards):
+        # Every Ref and GetAtt in a shard has to point at something in that shard or at one of its parameters, and every parameter
+        # the parent passes in has to come from the parent itself or from an output another shard actually has.
+        parent_resources = parent["Resources"]
+        for shard_name in shards:
+            shard = shards[shard_name]
+            for name in shard["Resources"]:
+                for ref_name, attribute in find_references(shard["Resources"][name]):
+                    self.assertTrue(ref_name in shard["Resources"] or (attribute == None and ref_name in shard["Parameters"]), ref_name)
+            parameters = parent_resources[shard_name]["Properties"]["Parameters"]
+            self.assertEqual(set(parameters.keys()), set(shard["Parameters"].keys()))
+            for value in parameters.values():
+                for ref_name, attribute in find_references(value):
+                    if ref_name in shards:
+                        self.assertNotEqual(ref_name, shard_name)
+                        self.assertIn(attribute[len("Outputs."):], shards[ref_name]["Outputs"])
+                    else:
+                        self.assertIn(ref_name, parent_resources)
+        for section in ["Resources", "Outputs"]:
+            for ref_name, attribute in find_references(parent[section]):
+                self.assertIn(ref_name, parent_resources)
+
+    def test_cross_shard_references_resolve(self):
+        template, names = build_template()
+        parent, shards, urls = shard(template, names)
+        self.assertGreater(len(shards), 1)
+        self.assertEqual(urls, shards)
+        self.assertResolves(parent, shards)
+        for name in names:
+            self.assertNotIn(name, parent["Resources"])
+        self.assertEqual(sum([len(shards[shard_name]["Resources"]) for shard_name in shards]), len(names))
+
+    def test_parent_outputs_follow_moved_resources(self):
+        template, names = build_template()
+        parent, shards, urls = shard(template, names)
+        location = parent["Metadata"][SHARD_METADATA_KEY]
+        shard_name = canonicalize.canonical_shard_name(location["Top0"])
+        self.assertEqual(parent["Outputs"]["Top0Id"]["Value"], {"Fn::GetAtt":[shard_name, "Outputs.Top0"]})
+        self.assertEqual(shards[shard_name]["Outputs"]["Top0"]["Value"], {"Ref":"Top0"})
+        self.assertEqual(parent["Outputs"]["RestApiId"]["Value"], {"Ref":"Api"})
+
+    def test_previous_placement_is_kept(self):
+        template, names = build_template()
+        # The first deploy only had the first few paths, so everything else is new the second time round.
+        first, first_shards, urls = shard(template, names[:6])
+        previous = {name:None for name in template["Resources"] if name not in names}
+        previous.update(first["Metadata"][SHARD_METADATA_KEY])
+        parent, shards, urls = shard(template, names, previous=previous)
+        placement = parent["Metadata"][SHARD_METADATA_KEY]
+        for name in first["Metadata"][SHARD_METADATA_KEY]:
+            self.assertEqual(placement[name], first["Metadata"][SHARD_METADATA_KEY][name])
+        for name in names[6:]:
+            self.assertIn(name, placement)
+        self.assertResolves(parent, shards)
+
+    def test_names_deployed_in_the_parent_stay_there(self):
+        template, names = build_template()
+        previous = {name:None for name in template["Resources"]}
+        del previous["Top2Child1"]
+        del previous["Top2Child1GET"]
+        parent, shards, urls = shard(template, names, previous=previous)
+        self.assertEqual(list(shards.keys()), [canonicalize.canonical_shard_name(0)])
+        self.assertEqual(sorted(shards[canonicalize.canonical_shard_name(0)]["Resources"].keys()), ["Top2Child1", "Top2Child1GET"])
+        for name in previous:
+            self.assertEqual(parent["Resources"][name]["Type"], template["Resources"][name]["Type"])
+        self.assertResolves(parent, shards)
+
+    def test_depends_on_is_rewritten(self):
+        template, names = build_template()
+        resources = template["Resources"]
+        resources["Top0Child0GET"]["DependsOn"] = ["Top0Child0", "Handler"]
+        parent, shards, urls = shard(template, names)
+        location = {name:canonicalize.canonical_shard_name(index) for name, index in parent["Metadata"][SHARD_METADATA_KEY].items()}
+        # The deployment waits on the shards holding its methods rather than on the methods themselves.
+        self.assertEqual(parent["Resources"]["Deployment"]["DependsOn"], sorted(set(location.values())))
+        # Dependencies inside a shard stay where they are; ones on the parent move onto the shard's stack resource.
+        method_shard = location["Top0Child0GET"]
+        method = shards[method_shard]["Resources"]["Top0Child0GET"]
+        self.assertEqual(method.get("DependsOn", []), ["Top0Child0"] if location["Top0Child0"] == method_shard else [])
+        self.assertIn("Handler", parent["Resources"][method_shard]["DependsOn"])
+        self.assertNotIn(method_shard, parent["Resources"][method_shard]["DependsOn"])
+
+if __name__ == "__main__":
+    unittest.main()
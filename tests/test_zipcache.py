@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from sunyata.upload import zip_directory
+
+CONFIG_PATH = "sunyata_config.json"
+CONFIG = {"stage":"test", "values":[1, 2, 3]}
+
+class TestCachedZipDirectory(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tempdir, "source")
+        self.cache_dir = os.path.join(self.tempdir, "cache")
+        os.makedirs(os.path.join(self.source, "package"))
+        with open(os.path.join(self.source, "handler.py"), "w") as f:
+            f.write("def handler(event, context):\n    return event\n" * 200)
+        with open(os.path.join(self.source, "package", "data.json"), "w") as f:
+            f.write('{"key":"value"}\n' * 500)
+        # .so is stored rather than deflated under the default policy.
+        with open(os.path.join(self.source, "package", "native.so"), "wb") as f:
+            f.write(os.urandom(4096))
+        os.chmod(os.path.join(self.source, "handler.py"), 0o755)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def build(self, cache_dir=None, compression=None):
+        with zip_directory(self.source, config_path=CONFIG_PATH, config=CONFIG, cache_dir=cache_dir, compression=compression) as fileobj:
+            return fileobj.read()
+
+    def open_archive(self, body, name="check.zip"):
+        path = os.path.join(self.tempdir, name)
+        with open(path, "wb") as f:
+            f.write(body)
+        return zipfile.ZipFile(path)
+
+    def assert_identical(self, compression=None):
+        uncached = self.build(compression=compression)
+        # The first cached build fills the cache and the second is served from it; both have to match the uncached one.
+        self.assertEqual(self.build(cache_dir=self.cache_dir, compression=compression), uncached)
+        self.assertEqual(self.build(cache_dir=self.cache_dir, compression=compression), uncached)
+        return uncached
+
+    def test_cached_archive_is_byte_identical(self):
+        body = self.assert_identical()
+        with self.open_archive(body) as archive:
+            self.assertIsNone(archive.testzip())
+            compress_types = {info.filename:info.compress_type for info in archive.infolist()}
+        self.assertEqual(compress_types["package/native.so"], zipfile.ZIP_STORED)
+        self.assertEqual(compress_types["handler.py"], zipfile.ZIP_DEFLATED)
+        self.assertEqual(compress_types["package/data.json"], zipfile.ZIP_DEFLATED)
+        self.assertIn(CONFIG_PATH, compress_types)
+
+    def test_compression_level_is_applied(self):
+        fast = self.assert_identical({"level":0})
+        best = self.assert_identical({"level":9})
+        with self.open_archive(fast, "fast.zip") as fast_archive, self.open_archive(best, "best.zip") as best_archive:
+            self.assertIsNone(fast_archive.testzip())
+            self.assertIsNone(best_archive.testzip())
+            self.assertGreater(fast_archive.getinfo("handler.py").compress_size, best_archive.getinfo("handler.py").compress_size)
+
+if __name__ == "__main__":
+    unittest.main()